@@ -1,28 +1,58 @@
 import os
+import hmac
+import hashlib
 import jwt
 from functools import wraps
 from datetime import datetime, timezone, timedelta
 from flask import request, jsonify, current_app
 import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError
+
+# New passwords are Argon2id; bcrypt and legacy sha256 hashes still verify below
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+
+def hash_password(password):
+    return password_hasher.hash(password)
 
 
 def verify_password(stored, provided):
     if not stored or not provided:
         return False
     try:
+        if isinstance(stored, (bytes, bytearray)) and bytes(stored).startswith(b'$argon2'):
+            stored = bytes(stored).decode('utf-8')
+        if isinstance(stored, str) and stored.startswith('$argon2'):
+            try:
+                return password_hasher.verify(stored, provided)
+            except VerificationError:
+                return False
         if isinstance(stored, (bytes, bytearray)):
             return bcrypt.checkpw(provided.encode('utf-8'), stored)
         if isinstance(stored, str):
             try:
                 return bcrypt.checkpw(provided.encode('utf-8'), stored.encode('utf-8'))
             except Exception:
-                import hashlib
-                return hashlib.sha256(provided.encode('utf-8')).hexdigest() == stored
+                legacy = hashlib.sha256(provided.encode('utf-8')).hexdigest()
+                return hmac.compare_digest(legacy, stored)
     except Exception:
         return False
     return False
 
 
+def needs_rehash(stored):
+    """
+    True if a (verified) stored hash is not Argon2id with the current
+    parameters, i.e. it should be replaced by hash_password() on login.
+    """
+    if isinstance(stored, (bytes, bytearray)):
+        return True
+    if not isinstance(stored, str) or not stored.startswith('$argon2'):
+        return True
+    return password_hasher.check_needs_rehash(stored)
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -1,9 +1,45 @@
 from flask import Flask
 from pymongo import MongoClient
 from gridfs import GridFS
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
 import os
 
 
+def cleanup_orphaned_chunks(db, batch_size=10000, grace=timedelta(hours=1)):
+    # The TTL index removes fs.files documents but not their fs.chunks.
+    # Find parentless files_id values server-side and delete their chunks in batches.
+    # GridFS writes chunks before the fs.files document, so files_id values newer
+    # than `grace` may belong to an upload still in progress and are left alone.
+    cutoff = ObjectId.from_datetime(datetime.now(timezone.utc) - grace)
+    pipeline = [
+        # first, so the files_id_1_n_1 index bounds the scan instead of sorting every chunk
+        {'$match': {'files_id': {'$lt': cutoff}}},
+        {'$sort': {'files_id': 1}},
+        {'$group': {'_id': '$files_id'}},
+        # existence check only: join just the parent's _id, not its metadata
+        {'$lookup': {
+            'from': 'fs.files',
+            'localField': '_id',
+            'foreignField': '_id',
+            'pipeline': [{'$project': {'_id': 1}}],
+            'as': 'parent',
+        }},
+        {'$match': {'parent': {'$size': 0}}},
+        {'$project': {'_id': 1}},
+    ]
+    deleted = 0
+    batch = []
+    for doc in db.fs.chunks.aggregate(pipeline, allowDiskUse=True):
+        batch.append(doc['_id'])
+        if len(batch) >= batch_size:
+            deleted += db.fs.chunks.delete_many({'files_id': {'$in': batch}}).deleted_count
+            batch = []
+    if batch:
+        deleted += db.fs.chunks.delete_many({'files_id': {'$in': batch}}).deleted_count
+    return deleted
+
+
 def create_app():
     app = Flask(__name__)
 
@@ -17,6 +53,12 @@ def create_app():
     client = MongoClient(mongo_url)
     db = client.video_storage_db
     db.fs.files.create_index('uploadDate', expireAfterSeconds=604800)
+    # /search filters: plate (+ camera) and camera-only time ranges
+    db.fs.files.create_index([('metadata.plate_numbers', 1), ('metadata.camera_id', 1), ('uploadDate', -1)])
+    db.fs.files.create_index([('metadata.plate_numbers', 1), ('uploadDate', -1)])
+    db.fs.files.create_index([('metadata.camera_id', 1), ('uploadDate', -1)])
+    # content hash of the plaintext clip, used to skip duplicate uploads
+    db.fs.files.create_index('metadata.sha256', partialFilterExpression={'metadata.sha256': {'$exists': True}})
     fs = GridFS(db)
     app.config['DB'] = db
     app.config['FS'] = fs
@@ -1,7 +1,7 @@
-import bcrypt
 from datetime import datetime, timezone
 import os
 from pymongo import MongoClient
+from src.server.auth import hash_password
 
 # Simple helper functions for user management used by server
 client = MongoClient(os.environ.get('EV_MONGO'))
@@ -12,7 +12,7 @@ db.users.create_index("username", unique=True)
 
 def create_user(username, email, password, role='viewer', cameras=None):
     cameras = cameras or []
-    hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    hashed_pw = hash_password(password)
     user_id = db.users.insert_one({
         'username': username,
         'email': email,
@@ -31,3 +31,7 @@ def find_by_email(email):
 
 def find_by_username(username):
     return db.users.find_one({'username': username})
+
+
+def update_password_hash(user_id, hashed_pw):
+    db.users.update_one({'_id': user_id}, {'$set': {'password': hashed_pw}})
@@ -1,6 +1,6 @@
 from flask import Blueprint, request, jsonify, current_app
-from src.server.user import find_by_email, find_by_username, create_user
-from src.server.auth import verify_password, make_token_for_user
+from src.server.user import find_by_email, find_by_username, create_user, update_password_hash
+from src.server.auth import verify_password, needs_rehash, hash_password, make_token_for_user
 
 bp = Blueprint('users', __name__)
 
@@ -20,6 +20,10 @@ def auth_login():
     if not verify_password(user.get('password'), password):
         return jsonify({'error': 'Invalid credentials'}), 401
 
+    # upgrade legacy sha256 / bcrypt hashes now that we have the plaintext
+    if needs_rehash(user.get('password')):
+        update_password_hash(user['_id'], hash_password(password))
+
     token = make_token_for_user(user)
     resp = jsonify({'username': user['username'], 'role': user.get('role', 'viewer')})
     secure_flag = current_app.config.get('SECURE_COOKIES', False)
@@ -1,11 +1,16 @@
 from flask import Blueprint, request, jsonify, current_app, Response
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
 from src.server.auth import token_required
 from src.encryption import decryption as decryption_mod
 import os
 
 bp = Blueprint('videos', __name__)
 
+# Read size for HTTP Range responses
+RANGE_BLOCK = 1 << 20
+
 
 def get_fs():
     return current_app.config['FS']
@@ -23,11 +28,43 @@ def stream_video(video_id):
         if user_payload.get('role') != 'admin' and cam_id not in user_payload.get('assigned_cameras', []):
             return jsonify({"error": "Not authorized to view this camera's video"}), 403
 
-        def generate():
-            for chunk in video_file:
+        size = video_file.length
+        headers = {'Accept-Ranges': 'bytes'}
+
+        # multi-range and non-bytes requests are answered with the full body (RFC 9110
+        # lets a server ignore Range); only single byte ranges get 206 / 416
+        if request.range is None or request.range.units != 'bytes' or len(request.range.ranges) != 1:
+            def generate():
+                # readchunk() pulls chunks through the GridOut's single fs.chunks cursor
+                while True:
+                    chunk = video_file.readchunk()
+                    if not chunk:
+                        break
+                    yield chunk
+
+            headers['Content-Length'] = str(size)
+            return Response(generate(), mimetype='application/octet-stream', headers=headers)
+
+        # Range request (seeking players, resumed downloads): serve only that span
+        span = request.range.range_for_length(size)
+        if span is None:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        start, stop = span
+        video_file.seek(start)
+
+        def generate_range():
+            remaining = stop - start
+            while remaining > 0:
+                chunk = video_file.read(min(RANGE_BLOCK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
                 yield chunk
 
-        return Response(generate(), mimetype='application/octet-stream')
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(generate_range(), status=206, mimetype='application/octet-stream', headers=headers)
     except Exception:
         return jsonify({"error": "Video not found"}), 404
 
@@ -103,24 +140,32 @@ def search_videos():
             return jsonify({'error': 'Invalid format. Use Date: YYYY-MM-DD, Time: HH:MM:SS'}), 400
 
     db = current_app.config['DB']
-    cursor = db.fs.files.find(query)
+    # $match first so the fs.files indexes are used; IST formatting happens server-side
+    pipeline = [
+        {'$match': query},
+        {'$project': {
+            'filename': 1,
+            'camera_id': '$metadata.camera_id',
+            'plate_numbers': {'$ifNull': ['$metadata.plate_numbers', []]},
+            'upload_date_ist': {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$uploadDate', 'timezone': 'Asia/Kolkata'}},
+        }},
+    ]
+    cursor = db.fs.files.aggregate(pipeline, batchSize=200)
     results = []
-    from datetime import timedelta
     for video in cursor:
-        utc_time = video['uploadDate']
-        ist_time = utc_time + timedelta(hours=5, minutes=30)
         results.append({
             'video_id': str(video['_id']),
             'filename': video['filename'],
-            'camera_id': video.get('metadata', {}).get('camera_id'),
-            'upload_date_ist': ist_time.strftime('%Y-%m-%d %H:%M:%S'),
-            'plates_found': video.get('metadata', {}).get('plate_numbers', [])
+            'camera_id': video.get('camera_id'),
+            'upload_date_ist': video['upload_date_ist'],
+            'plates_found': video['plate_numbers']
         })
     if not results:
         return jsonify({'message': 'No results found'}), 404
     return jsonify(results), 200
 
 
+@bp.route('/update_plate/<video_id>', methods=['POST'])
 @token_required
 def update_plate(video_id):
     token = request.cookies.get('ev_token')
@@ -137,7 +182,36 @@ def update_plate(video_id):
     plate_numbers = data.get('plate_numbers')
     if not plate_numbers:
         return jsonify({'error': 'No plate number provided'}), 400
-    result = current_app.config['DB'].fs.files.update_one({'_id': ObjectId(video_id)}, {'$push': {'metadata.plate_numbers': plate_numbers}})
+    if isinstance(plate_numbers, list):
+        plate_numbers = {'$each': plate_numbers}
+    try:
+        oid = ObjectId(video_id)
+    except InvalidId:
+        return jsonify({'error': 'Video not found'}), 404
+    result = current_app.config['DB'].fs.files.update_one({'_id': oid}, {'$addToSet': {'metadata.plate_numbers': plate_numbers}})
     if result.matched_count == 0:
         return jsonify({'error': 'Video not found'}), 404
     return jsonify({'message': 'Plate added to metadata'}), 200
+
+
+@bp.route('/update_plates_bulk', methods=['POST'])
+@token_required
+def update_plates_bulk():
+    # body: [{"video_id": ..., "plate": ...}, ...] -> one unordered bulk write
+    user_payload = request.user
+    if user_payload.get('role') not in ['uploader', 'admin']:
+        return jsonify({'error': 'No permission to update metadata'}), 403
+    items = request.get_json() or []
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Expected a list of {video_id, plate}'}), 400
+    try:
+        ops = [
+            UpdateOne({'_id': ObjectId(item['video_id'])}, {'$addToSet': {'metadata.plate_numbers': item['plate']}})
+            for item in items if item.get('plate')
+        ]
+    except (KeyError, TypeError, AttributeError, InvalidId):
+        return jsonify({'error': 'Each item needs a valid video_id and plate'}), 400
+    if not ops:
+        return jsonify({'error': 'No plate number provided'}), 400
+    result = current_app.config['DB'].fs.files.bulk_write(ops, ordered=False)
+    return jsonify({'matched': result.matched_count, 'modified': result.modified_count}), 200
@@ -1,4 +1,5 @@
 import threading
+import queue
 import time
 import os
 import subprocess
@@ -6,6 +7,7 @@ from pathlib import Path
 from datetime import datetime
 import csv
 import shutil
+import hashlib
 from src.encryption.keyGeneration import load_key
 
 load_key()  # Ensure key is generated at startup
@@ -20,50 +22,92 @@ LOGS_DIR = RAW_DIR / 'logs'
 CV_OUT = DATA_DIR / 'cv2.mp4'
 PLATE_CSV = LOGS_DIR / 'plate_log.csv'
 CAMERA_ID = os.environ.get('EV_CAMERA_ID', 'CAM_01')
+GRIDFS_READ_SIZE = 8 * 1024 * 1024
+# How long workers block on their queue before re-checking stop_event
+QUEUE_TIMEOUT = 1.0
+# Fallback directory scan for clips not handed over through the queue
+CV_POLL = int(os.environ.get('EV_CV_POLL', 30))
+CLEANUP_INTERVAL = int(os.environ.get('EV_CLEANUP_INTERVAL', 3600))
+GRIDFS_CHUNK_SIZE = int(os.environ.get('EV_GRIDFS_CHUNK_SIZE', 4 * 1024 * 1024))
+
+def file_sha256(path):
+    # Chunked so memory stays flat; file_digest (3.11+) hashes in C without Python-level reads
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        h = hashlib.sha256()
+        while True:
+            chunk = f.read(GRIDFS_READ_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+        return h.hexdigest()
+
 
-def record_thread(stop_event):
-    # Run the recorder (blocks) in this thread
+def record_thread(stop_event, clips):
+    # Run the recorder (blocks) in this thread; finished recordings go to the cv queue
     from src.record import record
     try:
-        record()
+        record(on_clip=clips.put)
     except Exception as e:
         print('record_thread error:', e)
 
 
-def cv_thread(stop_event):
-    # Watch for new motion recordings (motion_*.mp4 / .avi) and run plates_detect
+def cv_thread(stop_event, clips, processed):
+    # Run plates_detect on each motion recording (motion_*.mp4 / .avi) as soon as it is queued
     import subprocess
     RAW_GLOB = ['motion_*.mp4', 'motion_*.avi']
-    while not stop_event.is_set():
+
+    def scan(min_age=0):
+        # queue recordings the recorder callback did not hand over (previous run,
+        # external recorder), oldest first; skip files still being written
         found = []
         for pat in RAW_GLOB:
             found.extend(list(ROOT.glob(pat)))
-        if found:
-            found.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-            video = found[0]
+        cutoff = time.time() - min_age
+        for p in sorted(found, key=lambda p: p.stat().st_mtime):
+            if p.stat().st_mtime <= cutoff:
+                clips.put(str(p))
+
+    scan()
+    next_scan = time.monotonic() + CV_POLL
+
+    while not stop_event.is_set():
+        if time.monotonic() >= next_scan:
             try:
-                # run plates_detect as a module; ensure working dir is backend
-                subprocess.run(
-                    ['python', '-m', 'src.plates_detect.plates_detect', '--video', str(video)],
-                    cwd=str(ROOT), check=False
-                )
-                # plates_detect writes data/cv2.mp4 and CSV logs under cwd
-                # move produced cv2.mp4 into DATA_DIR (it already writes to data/cv2.mp4)
-                produced = ROOT / 'data' / 'cv2.mp4'
-                if produced.exists():
-                    shutil.move(str(produced), str(CV_OUT))
-                # keep or remove original raw file
-                try:
-                    video.unlink()
-                except Exception:
-                    pass
+                scan(min_age=CV_POLL)
             except Exception as e:
-                print('cv_thread error:', e)
-
-        time.sleep(int(os.environ.get('EV_CV_POLL', 5)))
+                print('cv_thread scan error:', e)
+            next_scan = time.monotonic() + CV_POLL
+        try:
+            video = Path(clips.get(timeout=QUEUE_TIMEOUT))
+        except queue.Empty:
+            continue
+        # a clip can be queued twice (callback + scan); the first pass removes it
+        if not video.exists():
+            continue
+        try:
+            # run plates_detect as a module; ensure working dir is backend
+            subprocess.run(
+                ['python', '-m', 'src.plates_detect.plates_detect', '--video', str(video)],
+                cwd=str(ROOT), check=False
+            )
+            # plates_detect writes data/cv2.mp4 and CSV logs under cwd
+            # move produced cv2.mp4 into DATA_DIR (it already writes to data/cv2.mp4)
+            produced = ROOT / 'data' / 'cv2.mp4'
+            if produced.exists():
+                shutil.move(str(produced), str(CV_OUT))
+                processed.put(CV_OUT)
+            # keep or remove original raw file
+            try:
+                video.unlink()
+            except Exception:
+                pass
+        except Exception as e:
+            print('cv_thread error:', e)
 
 
-def encryption_thread(stop_event):
+def encryption_thread(stop_event, processed):
     from src.encryption import encryption
     from pymongo import MongoClient
     from gridfs import GridFS
@@ -73,14 +117,30 @@ def encryption_thread(stop_event):
     fs = GridFS(db)
     key = encryption.load_key()
 
+    # an output left behind by a previous run
+    if CV_OUT.exists():
+        processed.put(CV_OUT)
+
     while not stop_event.is_set():
+        try:
+            processed.get(timeout=QUEUE_TIMEOUT)
+        except queue.Empty:
+            continue
         if CV_OUT.exists():
             try:
+                # skip clips already stored (same content hash)
+                digest = file_sha256(CV_OUT)
+                if db.fs.files.find_one({'metadata.sha256': digest}, {'_id': 1}):
+                    print('encryption_thread: duplicate clip skipped', digest)
+                    CV_OUT.unlink()
+                    if PLATE_CSV.exists():
+                        PLATE_CSV.unlink()
+                    continue
+
                 # Create container and append encrypted chunk
                 container_path = encryption.create_new_container()
-                blob = encryption.encrypt_chunk_blob(str(CV_OUT), key)
-                with open(container_path, 'ab') as f:
-                    f.write(blob)
+                offset = encryption.append_chunk(container_path, str(CV_OUT), key)
+                encryption.close_container(container_path, [offset])
 
                 # read plates from CSV if available
                 plates = []
@@ -97,10 +157,9 @@ def encryption_thread(stop_event):
                     except Exception:
                         pass
 
-                # store container into GridFS with metadata
-                with open(container_path, 'rb') as f:
-                    container_bytes = f.read()
-                    fs.put(container_bytes, filename=os.path.basename(container_path), content_type='application/octet-stream', metadata={'camera_id': CAMERA_ID, 'plate_numbers': plates, 'is_encrypted': True, 'container_format': 'WattLagGyi'})
+                # stream container into GridFS with metadata (one read buffer at a time)
+                with open(container_path, 'rb') as f, fs.new_file(filename=os.path.basename(container_path), content_type='application/octet-stream', chunkSize=GRIDFS_CHUNK_SIZE, metadata={'camera_id': CAMERA_ID, 'plate_numbers': plates, 'is_encrypted': True, 'container_format': 'WattLagGyi', 'sha256': digest}) as grid_in:
+                    shutil.copyfileobj(f, grid_in, GRIDFS_READ_SIZE)
 
                 # cleanup
                 try:
@@ -120,7 +179,23 @@ def encryption_thread(stop_event):
             except Exception as e:
                 print('encryption_thread error:', e)
 
-        time.sleep(int(os.environ.get('EV_ENC_POLL', 3)))
+
+def cleanup_thread(stop_event):
+    # Periodically drop GridFS chunks whose fs.files entry expired via the TTL index
+    from src.server.server import cleanup_orphaned_chunks
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ.get('EV_MONGO'))
+    db = client.video_storage_db
+
+    # wait() returns as soon as stop_event is set instead of sleeping out the interval
+    while not stop_event.wait(timeout=CLEANUP_INTERVAL):
+        try:
+            deleted = cleanup_orphaned_chunks(db)
+            if deleted:
+                print('cleanup_thread: removed orphaned chunks:', deleted)
+        except Exception as e:
+            print('cleanup_thread error:', e)
 
 
 def server_thread(stop_event):
@@ -134,11 +209,14 @@ def server_thread(stop_event):
 
 def main():
     stop_event = threading.Event()
+    clips = queue.Queue()      # finished motion recordings -> cv_thread
+    processed = queue.Queue()  # cv outputs ready for encryption -> encryption_thread
 
     threads = [
-        threading.Thread(target=record_thread, args=(stop_event,), daemon=True),
-        threading.Thread(target=cv_thread, args=(stop_event,), daemon=True),
-        threading.Thread(target=encryption_thread, args=(stop_event,), daemon=True),
+        threading.Thread(target=record_thread, args=(stop_event, clips), daemon=True),
+        threading.Thread(target=cv_thread, args=(stop_event, clips, processed), daemon=True),
+        threading.Thread(target=encryption_thread, args=(stop_event, processed), daemon=True),
+        threading.Thread(target=cleanup_thread, args=(stop_event,), daemon=True),
         threading.Thread(target=server_thread, args=(stop_event,), daemon=True),
     ]
 
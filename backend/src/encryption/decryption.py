@@ -1,15 +1,32 @@
+import io
 import os
 import json
-import cv2
+import shutil
+import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from Crypto.Cipher import AES
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 
 ENC_FOLDER = os.environ.get("EV_ENC_FOLDER") or os.path.join(os.path.dirname(__file__), "data", "encrypted")
 OUTPUT_FOLDER = os.environ.get("EV_DEC_OUT") or os.path.join(os.path.dirname(__file__), "data", "decrypted")
 KEY_PATH = os.environ.get("EV_KEY_PATH") or os.path.join(os.path.dirname(__file__), "configs", "secret.key")
 
+# Containers written before the switch to GCM declare AES-256-EAX in their header
+MODE_EAX = "AES-256-EAX"
+MODE_GCM = "AES-256-GCM"
+GCM_NONCE_SIZE = 12
+TAG_SIZE = 16
+STREAM_BLOCK = 8 * 1024 * 1024
+
+# Footer written by encryption.close_container: json(offsets) + index_len[8] + magic
+INDEX_MAGIC = b"WLGIDX01"
+DECRYPT_WORKERS = int(os.environ.get("EV_DECRYPT_WORKERS", os.cpu_count() or 1))
+
 
 def load_key():
     if not os.path.exists(KEY_PATH):
@@ -25,11 +42,15 @@ def read_safe(f, size):
     return data
 
 
-def decrypt_chunk(f, key):
+def decrypt_chunk_to(f, key, out, mode=MODE_EAX):
+    """Stream-decrypt the next container record from `f` into `out`.
+    Returns False if the record is truncated or fails authentication;
+    anything already written to `out` must then be discarded.
+    """
 
     header_len_bytes = read_safe(f, 4)
     if not header_len_bytes:
-        return None
+        return False
 
     chunk_header_len = int.from_bytes(
         header_len_bytes,
@@ -38,84 +59,176 @@ def decrypt_chunk(f, key):
 
     header_bytes = read_safe(f, chunk_header_len)
     if not header_bytes:
-        return None
+        return False
 
     chunk_header = json.loads(
         header_bytes.decode()
     )
 
-    nonce = read_safe(f, 16)
-    tag = read_safe(f, 16)
+    file_size = chunk_header["file_size"]
+
+    if mode == MODE_GCM:
+        # nonce[12] + ciphertext + tag[16]
+        nonce = read_safe(f, GCM_NONCE_SIZE)
+        if not nonce:
+            return False
+        decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).decryptor()
+    else:
+        # legacy EAX: nonce[16] + tag[16] + ciphertext
+        nonce = read_safe(f, 16)
+        tag = read_safe(f, 16)
+        if not nonce or not tag:
+            return False
+        cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
+
+    # one ciphertext and one plaintext buffer reused for every block
+    # (GCM update_into needs block_size - 1 spare bytes on the output side)
+    ct = memoryview(bytearray(min(STREAM_BLOCK, file_size)))
+    pt = memoryview(bytearray(len(ct) + 15))
+
+    remaining = file_size
+    while remaining:
+        n = f.readinto(ct[:min(len(ct), remaining)])
+        if not n:
+            return False
+        if mode == MODE_GCM:
+            out.write(pt[:decryptor.update_into(ct[:n], pt)])
+        else:
+            cipher.decrypt(ct[:n], output=pt[:n])
+            out.write(pt[:n])
+        remaining -= n
 
-    if not nonce or not tag:
+    try:
+        if mode == MODE_GCM:
+            tag = read_safe(f, TAG_SIZE)
+            if not tag:
+                return False
+            out.write(decryptor.finalize_with_tag(tag))
+        else:
+            cipher.verify(tag)
+    except (InvalidTag, ValueError):
+        return False
+
+    return True
+
+
+def decrypt_chunk(f, key, mode=MODE_EAX):
+    """Same as decrypt_chunk_to, returning the plaintext bytes or None."""
+    buf = io.BytesIO()
+    if not decrypt_chunk_to(f, key, buf, mode):
         return None
+    return buf.getvalue()
 
-    file_size = chunk_header["file_size"]
 
-    ciphertext = read_safe(f, file_size)
-    if not ciphertext:
-        return None
+def read_index(f):
+    """Return the list of chunk offsets from the container footer, or None
+    for containers without one (older or still being written)."""
 
-    try:
-        cipher = AES.new(
-            key,
-            AES.MODE_EAX,
-            nonce=nonce
-        )
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    tail_len = 8 + len(INDEX_MAGIC)
 
-        plaintext = cipher.decrypt_and_verify(
-            ciphertext,
-            tag
-        )
+    if size < tail_len:
+        return None
 
-        return plaintext
+    f.seek(size - tail_len)
+    tail = f.read(tail_len)
+    if tail[8:] != INDEX_MAGIC:
+        return None
 
-    except:
+    index_len = int.from_bytes(tail[:8], "big")
+    if index_len > size - tail_len:
         return None
 
+    f.seek(size - tail_len - index_len)
+    return json.loads(f.read(index_len).decode())
+
+
+def decrypt_at(path, offset, key, mode, seg_path):
+    """Decrypt the record at `offset` into seg_path; safe to run in parallel."""
+
+    with open(path, "rb") as f, open(seg_path, "wb") as seg:
+        f.seek(offset)
+        return decrypt_chunk_to(f, key, seg, mode)
+
+
+def reencode_segments(segment_paths, output_path):
+    """Fallback join when ffmpeg is unavailable: decode every segment and
+    re-encode the frames into one mp4v file. Returns True on success."""
+
+    import cv2  # only this path needs OpenCV
+
+    writer = None
+
+    for seg in segment_paths:
+
+        cap = cv2.VideoCapture(seg)
+
+        if writer is None:
 
-def extract_video_props(video_bytes):
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-    with tempfile.NamedTemporaryFile(
-        delete=False,
-        suffix=".mp4"
-    ) as tmp:
-        tmp.write(video_bytes)
-        temp_path = tmp.name
+            if not (fps > 0 and width > 0 and height > 0):
+                cap.release()
+                continue
+
+            writer = cv2.VideoWriter(
+                output_path,
+                cv2.VideoWriter_fourcc(*"mp4v"),
+                fps,
+                (width, height)
+            )
+
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            writer.write(frame)
 
-    cap = cv2.VideoCapture(temp_path)
+        cap.release()
 
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if writer is None:
+        return False
 
-    valid = fps > 0 and width > 0 and height > 0
+    writer.release()
+    return True
 
-    cap.release()
-    os.remove(temp_path)
 
-    return valid, fps, width, height
+def concat_segments(segment_paths, output_path):
+    """Join same-codec mp4 segments with ffmpeg's concat demuxer (stream copy,
+    no re-encode). Without ffmpeg, or if it fails, falls back to an OpenCV
+    re-encode. Returns True on success."""
 
+    if len(segment_paths) == 1:
+        shutil.move(segment_paths[0], output_path)
+        return True
 
-def append_video(writer, video_bytes):
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        print("ffmpeg not found; re-encoding decrypted chunks with OpenCV "
+              "(install ffmpeg to join them without re-encoding: "
+              "sudo apt install -y ffmpeg)")
+        return reencode_segments(segment_paths, output_path)
 
-    with tempfile.NamedTemporaryFile(
-        delete=False,
-        suffix=".mp4"
-    ) as tmp:
-        tmp.write(video_bytes)
-        temp_path = tmp.name
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), "segments.txt")
+    with open(list_path, "w") as lst:
+        for seg in segment_paths:
+            lst.write(f"file '{seg}'\n")
 
-    cap = cv2.VideoCapture(temp_path)
+    result = subprocess.run(
+        [ffmpeg, "-y", "-loglevel", "error",
+         "-f", "concat", "-safe", "0", "-i", list_path,
+         "-c", "copy", output_path],
+        check=False
+    )
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        writer.write(frame)
+    if result.returncode != 0:
+        print("ffmpeg concat failed; re-encoding decrypted chunks with OpenCV")
+        return reencode_segments(segment_paths, output_path)
 
-    cap.release()
-    os.remove(temp_path)
+    return True
 
 
 def decrypt_container(path, key):
@@ -127,54 +240,63 @@ def decrypt_container(path, key):
         name.replace(".WattLagGyi", ".mp4")
     )
 
-    writer = None
-
-    with open(path, "rb") as f:
+    with tempfile.TemporaryDirectory() as seg_dir:
 
-        header_len_bytes = read_safe(f, 4)
-        if not header_len_bytes:
-            return
+        segments = []
 
-        header_len = int.from_bytes(
-            header_len_bytes,
-            "big"
-        )
+        with open(path, "rb") as f:
 
-        if not read_safe(f, header_len):
-            return
+            header_len_bytes = read_safe(f, 4)
+            if not header_len_bytes:
+                return
 
-        while True:
+            header_len = int.from_bytes(
+                header_len_bytes,
+                "big"
+            )
 
-            chunk_bytes = decrypt_chunk(f, key)
+            header_bytes = read_safe(f, header_len)
+            if not header_bytes:
+                return
 
-            if not chunk_bytes:
-                break
+            mode = json.loads(header_bytes.decode()).get("encryption", MODE_EAX)
 
-            if writer is None:
+            offsets = read_index(f)
+            f.seek(4 + header_len)
 
-                valid, fps, w, h = extract_video_props(
-                    chunk_bytes
-                )
+            while offsets is None:
 
-                if not valid:
-                    continue
+                # decrypt each chunk straight to its own segment file
+                seg_path = os.path.join(seg_dir, f"seg_{len(segments):04d}.mp4")
+                with open(seg_path, "wb") as seg:
+                    ok = decrypt_chunk_to(f, key, seg, mode)
 
-                fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+                if not ok or os.path.getsize(seg_path) == 0:
+                    os.remove(seg_path)
+                    break
 
-                writer = cv2.VideoWriter(
-                    output_path,
-                    fourcc,
-                    fps,
-                    (w, h)
-                )
+                segments.append(seg_path)
 
-            append_video(writer, chunk_bytes)
+        if offsets:
+            # indexed container: records are independent, decrypt them concurrently
+            seg_paths = [
+                os.path.join(seg_dir, f"seg_{i:04d}.mp4")
+                for i in range(len(offsets))
+            ]
+            with ThreadPoolExecutor(max_workers=max(1, min(DECRYPT_WORKERS, len(offsets)))) as ex:
+                oks = list(ex.map(
+                    lambda job: decrypt_at(path, job[0], key, mode, job[1]),
+                    zip(offsets, seg_paths)
+                ))
+            segments = [
+                seg for seg, ok in zip(seg_paths, oks)
+                if ok and os.path.getsize(seg) > 0
+            ]
 
-    if writer:
-        writer.release()
-        print(f"Decrypted → {name}")
-    else:
-        print(f"No valid video → {name}")
+        if segments and concat_segments(segments, output_path):
+            print(f"Decrypted → {name}")
+        else:
+            print(f"No valid video → {name}")
 
 
 def process_all():
@@ -197,7 +319,8 @@ def process_all():
 
 def decrypt_blob_to_path(blob_bytes, key):
     """Attempt to decrypt a blob that may be either:
-    - a simple AES-EAX blob (nonce[16] + tag[16] + ciphertext)
+    - a simple AES-GCM blob (nonce[12] + ciphertext + tag[16])
+    - a legacy simple AES-EAX blob (nonce[16] + tag[16] + ciphertext)
     - or a container format produced by the original encrypt script
     Returns path to temporary .mp4 file or None on failure.
     """
@@ -205,7 +328,20 @@ def decrypt_blob_to_path(blob_bytes, key):
 
     b = BytesIO(blob_bytes)
 
-    # Try simple format first
+    # Try simple formats first
+    try:
+        if len(blob_bytes) > GCM_NONCE_SIZE + TAG_SIZE:
+            nonce = blob_bytes[:GCM_NONCE_SIZE]
+            plaintext = AESGCM(key).decrypt(nonce, blob_bytes[GCM_NONCE_SIZE:], None)
+
+            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
+            tmp.write(plaintext)
+            tmp.flush()
+            tmp.close()
+            return tmp.name
+    except Exception:
+        pass
+
     try:
         b.seek(0)
         # read first 16 + 16
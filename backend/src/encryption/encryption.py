@@ -1,9 +1,11 @@
+import io
 import os
 import json
 import time
 import uuid
 from datetime import datetime
-from Crypto.Cipher import AES
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 
 RAW_FOLDER = os.environ.get("EV_RAW_FOLDER") or os.path.join(os.path.dirname(__file__), "data", "raw_buffer")
@@ -14,6 +16,13 @@ SCAN_INTERVAL = int(os.environ.get("EV_SCAN_INTERVAL", 10))
 MAX_CONTAINER_DURATION = int(os.environ.get("EV_MAX_CONTAINER_DURATION", 15))
 CHUNK_DURATION = int(os.environ.get("EV_CHUNK_DURATION", 3))
 
+NONCE_SIZE = 12
+TAG_SIZE = 16
+STREAM_BLOCK = 8 * 1024 * 1024
+
+# Closed containers end with: json(chunk offsets) + index_len[8] + INDEX_MAGIC
+INDEX_MAGIC = b"WLGIDX01"
+
 
 def load_key():
     if not os.path.exists(KEY_PATH):
@@ -49,7 +58,7 @@ def create_new_container():
     header = {
         "created_at": str(datetime.now()),
         "container_id": uid,
-        "encryption": "AES-256-EAX",
+        "encryption": "AES-256-GCM",
         "max_duration_min": MAX_CONTAINER_DURATION
     }
 
@@ -63,15 +72,13 @@ def create_new_container():
     return path
 
 
-def encrypt_chunk_blob(file_path, key):
-
-    with open(file_path, "rb") as f:
-        data = f.read()
-
-    cipher = AES.new(key, AES.MODE_EAX)
-    ciphertext, tag = cipher.encrypt_and_digest(data)
+def encrypt_chunk_to(file_path, key, out):
+    """Stream-encrypt one file into `out` as a container record:
+    header_len[4] + header + nonce[12] + ciphertext + tag[16]
+    Only one STREAM_BLOCK of plaintext is held in memory at a time.
+    """
 
-    file_size = len(data)
+    file_size = os.path.getsize(file_path)
 
     header = {
         "filename": os.path.basename(file_path),
@@ -83,20 +90,64 @@ def encrypt_chunk_blob(file_path, key):
     header_bytes = json.dumps(header).encode()
     header_len = len(header_bytes).to_bytes(4, "big")
 
-    return (
-        header_len +
-        header_bytes +
-        cipher.nonce +
-        tag +
-        ciphertext
-    )
+    nonce = os.urandom(NONCE_SIZE)
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+
+    out.write(header_len)
+    out.write(header_bytes)
+    out.write(nonce)
+
+    # one plaintext and one ciphertext buffer reused for every block
+    # (update_into needs block_size - 1 spare bytes on the output side)
+    pt = memoryview(bytearray(STREAM_BLOCK))
+    ct = memoryview(bytearray(STREAM_BLOCK + 15))
+
+    remaining = file_size
+    with open(file_path, "rb") as f:
+        while remaining:
+            n = f.readinto(pt[:min(STREAM_BLOCK, remaining)])
+            if not n:
+                raise RuntimeError(f"{file_path} shrank while encrypting")
+            out.write(ct[:encryptor.update_into(pt[:n], ct)])
+            remaining -= n
+
+    out.write(encryptor.finalize())
+    out.write(encryptor.tag)
+
+
+def encrypt_chunk_blob(file_path, key):
+    """Same record as encrypt_chunk_to, returned as bytes."""
+    buf = io.BytesIO()
+    encrypt_chunk_to(file_path, key, buf)
+    return buf.getvalue()
+
+
+def append_chunk(container_path, file_path, key):
+    """Encrypt file_path onto the end of the container; returns the record's offset."""
+
+    offset = os.path.getsize(container_path)
+
+    with open(container_path, "ab") as out:
+        encrypt_chunk_to(file_path, key, out)
+
+    return offset
+
+
+def close_container(container_path, offsets):
+    """Append the chunk index footer so records can be located without a scan."""
+
+    index_bytes = json.dumps(offsets).encode()
+
+    with open(container_path, "ab") as out:
+        out.write(index_bytes)
+        out.write(len(index_bytes).to_bytes(8, "big"))
+        out.write(INDEX_MAGIC)
 
 
 def encrypt_bytes_whole(data_bytes, key):
-    """Encrypt arbitrary bytes with AES-EAX and return nonce+tag+ciphertext."""
-    cipher = AES.new(key, AES.MODE_EAX)
-    ciphertext, tag = cipher.encrypt_and_digest(data_bytes)
-    return cipher.nonce + tag + ciphertext
+    """Encrypt arbitrary bytes with AES-GCM and return nonce+ciphertext+tag."""
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + AESGCM(key).encrypt(nonce, data_bytes, None)
 
 
 def live_encrypt():
@@ -105,52 +156,59 @@ def live_encrypt():
 
     current_container = None
     current_duration = 0
+    current_offsets = []
 
     print("Live encryption started...")
 
-    while True:
-
-        files = sorted([
-            f for f in os.listdir(RAW_FOLDER)
-            if f.endswith(".mp4")
-        ])
+    try:
+        while True:
 
-        for file in files:
+            files = sorted([
+                f for f in os.listdir(RAW_FOLDER)
+                if f.endswith(".mp4")
+            ])
 
-            full_path = os.path.join(RAW_FOLDER, file)
+            for file in files:
 
-            if not wait_for_stable_file(full_path):
-                continue
+                full_path = os.path.join(RAW_FOLDER, file)
 
-            try:
+                if not wait_for_stable_file(full_path):
+                    continue
 
-                if current_container is None:
-                    current_container = create_new_container()
-                    current_duration = 0
+                try:
 
-                if current_duration + CHUNK_DURATION > MAX_CONTAINER_DURATION:
-                    current_container = create_new_container()
-                    current_duration = 0
+                    if current_container is None:
+                        current_container = create_new_container()
+                        current_duration = 0
+                        current_offsets = []
 
-                blob = encrypt_chunk_blob(full_path, key)
+                    if current_duration + CHUNK_DURATION > MAX_CONTAINER_DURATION:
+                        close_container(current_container, current_offsets)
+                        current_container = create_new_container()
+                        current_duration = 0
+                        current_offsets = []
 
-                with open(current_container, "ab") as out:
-                    out.write(blob)
+                    current_offsets.append(
+                        append_chunk(current_container, full_path, key)
+                    )
 
-                current_duration += CHUNK_DURATION
+                    current_duration += CHUNK_DURATION
 
-                os.remove(full_path)
+                    os.remove(full_path)
 
-                print(
-                    f"Encrypted → {file} "
-                    f"→ {os.path.basename(current_container)} "
-                    f"({current_duration} min)"
-                )
+                    print(
+                        f"Encrypted → {file} "
+                        f"→ {os.path.basename(current_container)} "
+                        f"({current_duration} min)"
+                    )
 
-            except Exception as e:
-                print(f"Error processing {file}: {e}")
+                except Exception as e:
+                    print(f"Error processing {file}: {e}")
 
-        time.sleep(SCAN_INTERVAL)
+            time.sleep(SCAN_INTERVAL)
+    finally:
+        if current_container is not None:
+            close_container(current_container, current_offsets)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import os
-from Crypto.Random import get_random_bytes
+import secrets
 
 BASE_DIR = os.path.dirname(__file__)
 CONFIG_DIR = os.path.join(BASE_DIR, "configs")
@@ -9,7 +9,7 @@ def load_key():
     if not os.path.exists(KEY_PATH):
         os.makedirs(CONFIG_DIR, exist_ok=True)
 
-        key = get_random_bytes(32)
+        key = secrets.token_bytes(32)
         with open(KEY_PATH, "wb") as f:
             f.write(key)
 
@@ -2,32 +2,89 @@
 import os
 import re
 import csv
+import json
+import string
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
 from datetime import datetime
+from functools import lru_cache, partial
+from urllib.request import Request, urlopen
 
 import cv2
 import numpy as np
+import torch
 import easyocr
 
 
 DEFAULT_PLATES_DIR = "data/raw_buffer/plates"
 DEFAULT_OUT_CSV = "data/raw_buffer/logs/plate_ocr.csv"
 
-ALNUM_RE = re.compile(r"[^A-Z0-9]+")
+# Bytes stripped by clean_text: everything but A-Z / 0-9
+NON_ALNUM = bytes(c for c in range(256) if c not in (string.ascii_uppercase + string.digits).encode())
 PLATE_RE = re.compile(r"^([A-Z]{2})([0-9]{1,2})([A-Z]{1,2})([0-9]{4})$")
 
 # Confusion fixes
 DIGIT_FIX = str.maketrans({"O": "0", "I": "1", "L": "1", "Z": "2", "S": "5", "B": "8", "G": "6", "D": "0"})
 LETTER_FIX = str.maketrans({"0": "O", "1": "I", "2": "Z", "5": "S", "8": "B", "6": "G"})
 
-# Init once (slow)
-reader = easyocr.Reader(["en"], gpu=False)
+# Same LL DD L{1,2} DDDD shape, but each slot also accepts the characters the
+# fix tables above map into it, so any hit becomes a valid plate after translate.
+# One overlapping (lookahead) scan per window length 8/9/10, shortest first and
+# 1-digit district before 2, i.e. the same preference order as the old window loop.
+_L = "[A-Z012568]"
+_D = "[0-9OILZSBGD]"
+INDIA_SCANS = tuple(
+    re.compile(rf"(?=({_L}{{2}})(?:{alts})({_D}{{4}}))")
+    for alts in (
+        rf"({_D})({_L})",
+        rf"({_D})({_L}{{2}})|({_D}{{2}})({_L})",
+        rf"({_D}{{2}})({_L}{{2}})",
+    )
+)
+
+# Created once per process (slow); see get_reader()
+reader = None
+
+# EasyOCR runs on the GPU when there is one; on CPU it keeps the int8-quantized recognizer
+USE_GPU = torch.cuda.is_available()
+
+
+def get_reader():
+    global reader
+    if reader is None:
+        if USE_GPU:
+            # no cudnn.benchmark: padded OCR batches change H x W on almost every call,
+            # so it would re-autotune per shape instead of paying off
+            torch.backends.cudnn.benchmark = False
+            torch.backends.cuda.matmul.allow_tf32 = True  # Ampere+ tensor cores
+            torch.backends.cudnn.allow_tf32 = True
+        reader = easyocr.Reader(["en"], gpu=USE_GPU, quantize=not USE_GPU)
+    return reader
+
+
+def init_threads(torch_threads: int):
+    """
+    Give torch's intra-op pool the cores and keep OpenCV single-threaded, so the
+    two OpenMP/TBB pools don't oversubscribe the CPU. Also used as the process
+    pool initializer (each worker gets cores / workers torch threads).
+    """
+    cv2.setNumThreads(1)
+    torch.set_num_threads(max(1, torch_threads))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # only settable before torch's first parallel op
+    get_reader()
 
 
 def clean_text(s: str) -> str:
-    return ALNUM_RE.sub("", (s or "").upper())
+    # bytes.translate deletes in a single C pass; non-ASCII is dropped by the encode
+    return (s or "").upper().encode("ascii", "ignore").translate(None, NON_ALNUM).decode("ascii")
 
 
+@lru_cache(maxsize=4096)  # pure; the same raw reads recur across variants, retries and frames
 def fix_india_plate(raw: str) -> str:
     """
     Try to correct common OCR confusions using a common India plate pattern:
@@ -37,42 +94,77 @@ def fix_india_plate(raw: str) -> str:
     if len(t) < 8:
         return t
 
-    # Search a window of 8..10 chars inside the OCR output
-    for L in range(8, 11):
-        for i in range(0, max(1, len(t) - L + 1)):
-            chunk = t[i : i + L]
+    # Regex sweeps instead of trying every window / district length in Python
+    for scan in INDIA_SCANS:
+        for m in scan.finditer(t):
+            g = [x for x in m.groups() if x is not None]  # state, district, series, number
+            candidate = (
+                g[0].translate(LETTER_FIX)
+                + g[1].translate(DIGIT_FIX)
+                + g[2].translate(LETTER_FIX)
+                + g[3].translate(DIGIT_FIX)
+            )
+            if PLATE_RE.match(candidate):
+                return candidate
 
-            # First two letters
-            a = chunk[:2].translate(LETTER_FIX)
-            rest = chunk[2:]
+    return t
 
-            # district 1 or 2 digits
-            for dlen in (1, 2):
-                if len(rest) < dlen + 1 + 4:
-                    continue
 
-                b = rest[:dlen].translate(DIGIT_FIX)      # digits
-                mid = rest[dlen:-4]                       # 1-2 letters
-                c = mid.translate(LETTER_FIX)             # letters
-                d = rest[-4:].translate(DIGIT_FIX)        # last 4 digits
+# Variants are 3.5x upscales; scoring at ~0.3x of that is roughly the source resolution
+SHARPNESS_SCALE = 0.3
 
-                candidate = a + b + c + d
-                if PLATE_RE.match(candidate):
-                    return candidate
 
-    return t
+def sharpness_score(gray: np.ndarray) -> float:
+    # 16-bit Laplacian on a downscaled copy; meanStdDev gives the variance in one C pass
+    small = cv2.resize(gray, None, fx=SHARPNESS_SCALE, fy=SHARPNESS_SCALE, interpolation=cv2.INTER_AREA)
+    lap = cv2.Laplacian(small, cv2.CV_16S, ksize=3)
+    _, stddev = cv2.meanStdDev(lap)
+    return float(stddev[0, 0] ** 2)
 
 
-def sharpness_score(gray: np.ndarray) -> float:
-    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+# CUDA build of OpenCV: upscale/CLAHE/bilateral/blur stay in VRAM (see preprocess_variants)
+USE_CUDA = hasattr(cv2, "cuda") and cv2.cuda.getCudaEnabledDeviceCount() > 0
+_cuda_clahe = None
+_cuda_blur = None
+
+
+def clahe_base_cuda(img_bgr: np.ndarray):
+    """
+    Variant-1 base (gray, 3.5x cubic upscale, CLAHE, bilateral) and its 5x5
+    Gaussian blur, computed on the GPU. Returns both as host arrays.
+    """
+    global _cuda_clahe, _cuda_blur
+    if _cuda_clahe is None:
+        _cuda_clahe = cv2.cuda.createCLAHE(clipLimit=2.5, tileGridSize=(8, 8))
+        _cuda_blur = cv2.cuda.createGaussianFilter(cv2.CV_8UC1, cv2.CV_8UC1, (5, 5), 0)
+
+    g = cv2.cuda_GpuMat()
+    g.upload(img_bgr)
+    g = cv2.cuda.cvtColor(g, cv2.COLOR_BGR2GRAY)
+    g = cv2.cuda.resize(g, None, fx=3.5, fy=3.5, interpolation=cv2.INTER_CUBIC)
+    g = _cuda_clahe.apply(g, cv2.cuda_Stream.Null())
+    g = cv2.cuda.bilateralFilter(g, 7, 60, 60)
+    blur = _cuda_blur.apply(g)
+    return g.download(), blur.download()
 
 
 def preprocess_variants(img_bgr: np.ndarray):
     """
     Produce multiple preprocessed versions.
     OCR sometimes reads digits better on binary images.
+    Runs on UMat so OpenCV can dispatch to OpenCL; results come back as arrays.
+    With a CUDA build, everything up to the thresholds runs through cv2.cuda instead
+    (cv2.cuda has no Otsu / adaptive threshold, so those stay on the CPU).
     """
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    if USE_CUDA:
+        v1, blur = clahe_base_cuda(img_bgr)
+        _, v2 = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        v3 = cv2.adaptiveThreshold(
+            v1, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10
+        )
+        return [("clahe", v1), ("otsu", v2), ("adapt", v3), ("inv_otsu", cv2.bitwise_not(v2))]
+
+    gray = cv2.cvtColor(cv2.UMat(img_bgr), cv2.COLOR_BGR2GRAY)
 
     # Upscale (digits need pixels!)
     gray = cv2.resize(gray, None, fx=3.5, fy=3.5, interpolation=cv2.INTER_CUBIC)
@@ -94,26 +186,30 @@ def preprocess_variants(img_bgr: np.ndarray):
     # Variant 4: Inverted Otsu (for yellow plates / dark background cases)
     v4 = cv2.bitwise_not(v2)
 
-    return [("clahe", v1), ("otsu", v2), ("adapt", v3), ("inv_otsu", v4)]
+    return [("clahe", v1.get()), ("otsu", v2.get()), ("adapt", v3.get()), ("inv_otsu", v4.get())]
+
+
+OCR_KWARGS = dict(
+    detail=1,
+    paragraph=False,
+    allowlist="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
+    decoder="beamsearch",
+    beamWidth=10,
+    text_threshold=0.5,
+    low_text=0.3,
+    contrast_ths=0.1,
+    adjust_contrast=0.7,
+)
 
 
-def ocr_easy(img_gray: np.ndarray):
+# A top-ranked variant that reads as a plate with this confidence is taken as-is
+EARLY_EXIT_CONF = 0.7
+
+
+def join_reads(results):
     """
-    Run EasyOCR with settings that help digits, return (text, conf).
+    Join EasyOCR line results left-to-right, return (text, conf).
     """
-    results = reader.readtext(
-        img_gray,
-        detail=1,
-        paragraph=False,
-        allowlist="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
-        decoder="beamsearch",
-        beamWidth=10,
-        text_threshold=0.5,
-        low_text=0.3,
-        contrast_ths=0.1,
-        adjust_contrast=0.7,
-    )
-
     if not results:
         return "", 0.0
 
@@ -136,6 +232,47 @@ def ocr_easy(img_gray: np.ndarray):
     return joined, avg_conf
 
 
+def background_value(img: np.ndarray) -> int:
+    """
+    Dominant grey level along the image border (plate background / frame).
+    """
+    edge = np.concatenate([img[0], img[-1], img[:, 0], img[:, -1]])
+    return int(np.median(edge))
+
+
+def pad_to_common(imgs):
+    """
+    Pad images (bottom/right) to the largest H and W in the list.
+    The fill is a flat background value: replicating the edge would smear
+    the last row/column into streaks the detector can read as extra 1/I boxes.
+    """
+    h = max(img.shape[0] for img in imgs)
+    w = max(img.shape[1] for img in imgs)
+    return [
+        img if img.shape[:2] == (h, w)
+        else cv2.copyMakeBorder(
+            img, 0, h - img.shape[0], 0, w - img.shape[1],
+            cv2.BORDER_CONSTANT, value=background_value(img),
+        )
+        for img in imgs
+    ]
+
+
+def ocr_easy_batch(imgs_gray):
+    """
+    Run EasyOCR with settings that help digits over a list of images, return
+    one (text, conf) per image. One batched call: detector + recognizer run
+    once per batch, not per image.
+    readtext_batched needs one shape, so images are padded, not resized.
+    """
+    if not imgs_gray:
+        return []
+    results = get_reader().readtext_batched(
+        pad_to_common(imgs_gray), batch_size=len(imgs_gray), **OCR_KWARGS
+    )
+    return [join_reads(r) for r in results]
+
+
 def plate_score(text: str, conf: float) -> float:
     """
     Prefer:
@@ -159,12 +296,158 @@ def iter_images(folder: str):
             yield f
 
 
+def read_image(path: str):
+    """
+    Read + decode one image; np.fromfile hands OpenCV a single uint8 buffer.
+    Returns None if the file is missing or not an image.
+    """
+    try:
+        buf = np.fromfile(path, dtype=np.uint8)
+    except OSError:
+        return None
+    if buf.size == 0:
+        return None
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+
+def prefetch_images(paths, workers: int = 4, depth: int = 8):
+    """
+    Yield (path, img) in order while the next `depth` images are read and
+    decoded on background threads (imdecode releases the GIL).
+    """
+    it = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as io:
+        pending = deque()
+        for path in it:
+            pending.append((path, io.submit(read_image, path)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            path, fut = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, io.submit(read_image, nxt)))
+            yield path, fut.result()
+
+
+def process_batch(paths, min_len: int = 6, debug: bool = False):
+    """
+    Read + OCR a list of plate images together. Returns one row (or None) per path.
+    """
+    return ocr_batch([(path, read_image(path)) for path in paths], min_len, debug)
+
+
+def ocr_batch(items, min_len: int = 6, debug: bool = False):
+    """
+    OCR a list of (path, img) pairs with at most two EasyOCR calls for the
+    whole list: the sharpest variant of every plate, then the remaining
+    variants of the plates that didn't give a confident read.
+    """
+    rows = [None] * len(items)
+    ranked = []  # (index, fname, variants sorted sharpest first)
+
+    for i, (path, img) in enumerate(items):
+        fname = os.path.basename(path)
+        if img is None:
+            print(f"⚠️ {fname} -> could not read")
+            continue
+        variants = [(tag, proc, sharpness_score(proc)) for tag, proc in preprocess_variants(img)]
+        variants.sort(key=lambda v: -v[2])
+        ranked.append((i, fname, variants))
+
+    if not ranked:
+        return rows
+
+    # pass 1: top variant of every plate
+    reads = [[r] for r in ocr_easy_batch([variants[0][1] for _, _, variants in ranked])]
+
+    # pass 2: everything else, only for plates without a confident plate-shaped read
+    retry = [
+        k for k, ((text, conf),) in enumerate(reads)
+        if not (PLATE_RE.match(fix_india_plate(text)) and conf > EARLY_EXIT_CONF)
+    ]
+    more = ocr_easy_batch([proc for k in retry for _, proc, _ in ranked[k][2][1:]])
+    pos = 0
+    for k in retry:
+        n = len(ranked[k][2]) - 1
+        reads[k] += more[pos : pos + n]
+        pos += n
+
+    for (i, fname, variants), plate_reads in zip(ranked, reads):
+        rows[i] = best_row(fname, variants, plate_reads, min_len, debug)
+    return rows
+
+
+def best_row(fname: str, variants, reads, min_len: int = 6, debug: bool = False):
+    """
+    Pick the best (variant, read) pair for one plate and build its CSV row.
+    """
+    best_text = ""
+    best_conf = 0.0
+    best_tag = ""
+    best_s = -1.0
+
+    for (tag, proc, s), (text, conf) in zip(variants, reads):
+        # Apply India plate correction (helps digits a LOT)
+        fixed = fix_india_plate(text)
+
+        score = plate_score(fixed, conf)
+
+        if debug:
+            print(f"   [{tag}] raw={text} fixed={fixed} conf={conf:.2f} sharp={s:.1f} score={score:.2f}")
+
+        if score > plate_score(best_text, best_conf):
+            best_text, best_conf, best_tag, best_s = fixed, conf, tag, s
+
+    # Filter junk
+    if len(best_text) < min_len:
+        best_text = ""
+        best_conf = 0.0
+
+    if best_text:
+        print(f"✅ {fname} -> {best_text} ({best_conf:.2f}) [{best_tag}]")
+    else:
+        print(f"✅ {fname} -> (no read)")
+
+    return [
+        fname,
+        best_text,
+        f"{best_conf:.4f}",
+        best_tag,
+        f"{best_s:.1f}",
+        datetime.now().isoformat(timespec="seconds")
+    ]
+
+
+def post_plates(url: str, video_id: str, plates, token: str = ""):
+    """
+    Send all plates read for one video to /update_plates_bulk in a single request.
+    """
+    body = json.dumps([{"video_id": video_id, "plate": p} for p in plates]).encode()
+    req = Request(url, data=body, method="POST", headers={"Content-Type": "application/json"})
+    if token:
+        req.add_header("Cookie", f"ev_token={token}")
+    with urlopen(req) as resp:
+        return json.loads(resp.read().decode() or "{}")
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--plates-dir", default=DEFAULT_PLATES_DIR)
     ap.add_argument("--out-csv", default=DEFAULT_OUT_CSV)
     ap.add_argument("--min-len", type=int, default=6)
+    ap.add_argument(
+        "--workers",
+        type=int,
+        # one GPU reader already saturates the device; extra processes just fight over it
+        default=1 if USE_GPU else (os.cpu_count() or 1),
+        help="OCR processes (1 = run in this process)",
+    )
+    ap.add_argument("--ocr-batch", type=int, default=32, help="plates per batched EasyOCR call")
     ap.add_argument("--debug", action="store_true", help="print extra debug info")
+    ap.add_argument("--post-url", default="", help="e.g. https://host/update_plates_bulk (optional)")
+    ap.add_argument("--video-id", default="", help="GridFS id of the video these plates belong to")
+    ap.add_argument("--token", default=os.environ.get("EV_TOKEN", ""), help="ev_token cookie for --post-url")
     args = ap.parse_args()
 
     if not os.path.isdir(args.plates_dir):
@@ -172,64 +455,61 @@ def main():
 
     os.makedirs(os.path.dirname(args.out_csv), exist_ok=True)
 
+    paths = [os.path.join(args.plates_dir, f) for f in iter_images(args.plates_dir)]
+    n = max(1, args.ocr_batch)
+    batches = [paths[i : i + n] for i in range(0, len(paths), n)]
+    work = partial(process_batch, min_len=args.min_len, debug=args.debug)
+
     rows = []
     total = 0
     good = 0
 
-    for fname in iter_images(args.plates_dir):
+    # Batches are independent: fan out over processes, each with its own reader
+    if args.workers > 1 and len(batches) > 1:
+        cores_per_worker = (os.cpu_count() or 1) // args.workers
+        # CUDA can't be used from a forked child, so GPU workers are spawned
+        ctx = get_context("spawn") if USE_GPU else None
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=ctx,
+            initializer=init_threads,
+            initargs=(cores_per_worker,),
+        ) as ex:
+            results = [row for batch_rows in ex.map(work, batches) for row in batch_rows]
+    else:
+        init_threads(os.cpu_count() or 1)
+
+        # overlap disk reads / JPEG decode with OCR of the previous batch
+        def ocr_prefetched():
+            items = []
+            for item in prefetch_images(paths, depth=max(8, n)):
+                items.append(item)
+                if len(items) == n:
+                    yield from ocr_batch(items, args.min_len, args.debug)
+                    items = []
+            if items:
+                yield from ocr_batch(items, args.min_len, args.debug)
+
+        results = ocr_prefetched()
+
+    for row in results:
         total += 1
-        path = os.path.join(args.plates_dir, fname)
-        img = cv2.imread(path)
-        if img is None:
-            print(f"⚠️ {fname} -> could not read")
+        if row is None:
             continue
-
-        best_text = ""
-        best_conf = 0.0
-        best_tag = ""
-        best_s = -1.0
-
-        for tag, proc in preprocess_variants(img):
-            # Skip very blurry variants quickly
-            s = sharpness_score(proc)
-            text, conf = ocr_easy(proc)
-
-            # Apply India plate correction (helps digits a LOT)
-            fixed = fix_india_plate(text)
-
-            score = plate_score(fixed, conf)
-
-            if args.debug:
-                print(f"   [{tag}] raw={text} fixed={fixed} conf={conf:.2f} sharp={s:.1f} score={score:.2f}")
-
-            if score > plate_score(best_text, best_conf):
-                best_text, best_conf, best_tag, best_s = fixed, conf, tag, s
-
-        # Filter junk
-        if len(best_text) < args.min_len:
-            best_text = ""
-            best_conf = 0.0
-
-        if best_text:
+        if row[1]:
             good += 1
-            print(f"✅ {fname} -> {best_text} ({best_conf:.2f}) [{best_tag}]")
-        else:
-            print(f"✅ {fname} -> (no read)")
-
-        rows.append([
-            fname,
-            best_text,
-            f"{best_conf:.4f}",
-            best_tag,
-            f"{best_s:.1f}",
-            datetime.now().isoformat(timespec="seconds")
-        ])
+        rows.append(row)
 
     with open(args.out_csv, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(["filename", "plate_text", "confidence", "best_variant", "sharpness", "processed_at"])
         w.writerows(rows)
 
+    if args.post_url and args.video_id:
+        plates = sorted({row[1] for row in rows if row[1]})
+        if plates:
+            print("Posted plates:", post_plates(args.post_url, args.video_id, plates, args.token))
+
     print("\nDONE ✅")
     print("Images processed:", total)
     print("Plates read:", good)
@@ -237,4 +517,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
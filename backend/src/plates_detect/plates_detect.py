@@ -1,21 +1,84 @@
 import os
+import csv
 import time
+import queue
 import argparse
-from collections import deque
+import threading
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import cv2
-import pandas as pd
+import numpy as np
+import torch
 from ultralytics import YOLO
 
+try:
+    import ffmpegcv  # optional: NVDEC/NVENC video I/O for --gpu-io
+except ImportError:
+    ffmpegcv = None
+
+try:
+    from numba import njit, prange  # optional: native Laplacian variance kernel
+except ImportError:
+    njit = None
+
+try:
+    from torchvision.io import encode_jpeg  # optional: nvJPEG plate encode for --gpu-jpeg
+except ImportError:
+    encode_jpeg = None
+
+# Tracking input size is fixed for a run, so let cuDNN autotune once (during warmup) and reuse.
+# Plate ROI batches vary in shape, so plate calls run with it off (cudnn_benchmark_off).
+torch.backends.cudnn.benchmark = True
+
+# Plate crops are small; q85 baseline JPEG is plenty for OCR and cheaper than the q95 default
+JPEG_QUALITY = 85
+
+# plate_log.csv columns (best-only adds plate_quality_score)
+LOG_COLUMNS = [
+    "timestamp",
+    "frame",
+    "plate_path",
+    "plate_conf",
+    "associated_vehicle_id",
+    "vehicles_in_frame",
+    "unique_vehicles_seen",
+]
+
+# plate_log.csv is flushed to disk every this many rows
+LOG_FLUSH_EVERY = 50
+
+# Plate detection runs on the union of vehicle boxes, grown by this many pixels
+ROI_MARGIN = 16
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+
+# Per-frame state carried through one --infer-batch window.
+# ids_host is the async host copy of vehicle_ids; unique_seen is filled in after the window sync;
+# unified_plates is (xyxy, conf) from the tracking pass with --unified-model, else None.
+FrameState = namedtuple(
+    "FrameState",
+    "frame_no frame vehicle_xyxy vehicle_ids cars_in_frame ids_host unique_seen unified_plates",
+)
+
 
 # ------------------ Rolling Buffer Writer ------------------
 class RollingBufferWriter:
     """
     Writes frames into chunked video files and keeps only the last N minutes.
     Uses mp4 when possible, falls back to avi if mp4 writer fails (common on WSL).
+    Encoding runs on a background thread fed by a bounded queue, so the
+    capture/inference loop doesn't block on it. When the queue is full,
+    write() waits (file input, no frame lost) or, with drop_when_full,
+    drops the oldest queued frame (live input, never stalls).
     """
 
+    MAX_PENDING = 64  # frames queued for encode
+
+    # hardware H.264 encoders tried through OpenCV's GStreamer backend, in order
+    GST_ENCODERS = ("nvh264enc bitrate=4000", "vaapih264enc bitrate=4000")
+
     def __init__(
         self,
         out_dir: str,
@@ -23,6 +86,8 @@ class RollingBufferWriter:
         frame_size: tuple[int, int],
         chunk_seconds: int,
         keep_minutes: int,
+        use_gpu: bool = False,
+        drop_when_full: bool = False,
     ):
         self.out_dir = out_dir
         self.fps = float(fps)
@@ -39,6 +104,43 @@ class RollingBufferWriter:
         self.mp4_fourcc = cv2.VideoWriter_fourcc(*"mp4v")
         self.avi_fourcc = cv2.VideoWriter_fourcc(*"XVID")
 
+        # NVENC only when asked for, ffmpegcv is installed and CUDA is present
+        self.use_gpu = bool(use_gpu and ffmpegcv is not None and torch.cuda.is_available())
+
+        # GStreamer tier: candidates until one opens, then only that one; () once none work
+        has_gst = hasattr(cv2, "videoio_registry") and cv2.videoio_registry.hasBackend(cv2.CAP_GSTREAMER)
+        self.gst_encoders = self.GST_ENCODERS if has_gst else ()
+
+        self.drop_when_full = drop_when_full
+        self.dropped = 0
+        self._error = None
+        self._q = queue.Queue(maxsize=self.MAX_PENDING)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _open_gpu_writer(self, path):
+        try:
+            return ffmpegcv.VideoWriterNV(path, "h264", self.fps, (self.w, self.h))
+        except Exception as e:
+            print(f"[buffer] NVENC writer unavailable ({e}), falling back to OpenCV", flush=True)
+            return None
+
+    def _open_gst_writer(self, path):
+        for enc in self.gst_encoders:
+            pipeline = (
+                "appsrc ! videoconvert ! " + enc + " ! h264parse ! mp4mux ! filesink location=" + path
+            )
+            writer = cv2.VideoWriter(pipeline, cv2.CAP_GSTREAMER, 0, self.fps, (self.w, self.h))
+            if writer.isOpened():
+                self.gst_encoders = (enc,)
+                return writer, enc.split()[0]
+            writer.release()
+
+        if self.gst_encoders:
+            print("[buffer] no GStreamer hardware encoder, falling back to OpenCV mp4v", flush=True)
+        self.gst_encoders = ()
+        return None, None
+
     def _start_new_chunk(self):
         ts = time.time()
         stamp = datetime.fromtimestamp(ts).strftime("%Y%m%d_%H%M%S")
@@ -46,7 +148,29 @@ class RollingBufferWriter:
         if self.cur_writer is not None:
             self.cur_writer.release()
 
+        # old chunks can only expire as new ones start, so cleanup runs per chunk, not per frame
+        self._cleanup_old()
+
         mp4_path = os.path.join(self.out_dir, f"chunk_{stamp}.mp4")
+
+        if self.use_gpu:
+            writer = self._open_gpu_writer(mp4_path)
+            if writer is not None:
+                self.cur_writer = writer
+                print(f"[buffer] started new chunk: {mp4_path} (nvenc)", flush=True)
+                self.cur_frame_count = 0
+                self.chunk_paths.append((ts, mp4_path))
+                return
+
+        if self.gst_encoders:
+            writer, enc = self._open_gst_writer(mp4_path)
+            if writer is not None:
+                self.cur_writer = writer
+                print(f"[buffer] started new chunk: {mp4_path} ({enc})", flush=True)
+                self.cur_frame_count = 0
+                self.chunk_paths.append((ts, mp4_path))
+                return
+
         writer = cv2.VideoWriter(mp4_path, self.mp4_fourcc, self.fps, (self.w, self.h))
 
         if not writer.isOpened():
@@ -87,7 +211,7 @@ class RollingBufferWriter:
                 except Exception:
                     pass
 
-    def write(self, frame):
+    def _write(self, frame):
         if self.cur_writer is None:
             self._start_new_chunk()
 
@@ -97,16 +221,56 @@ class RollingBufferWriter:
         if self.cur_frame_count >= self.frames_per_chunk:
             self._start_new_chunk()
 
-        self._cleanup_old()
+    def _drain(self):
+        while True:
+            frame = self._q.get()
+            if frame is None:  # close() sentinel
+                return
+            if self._error is not None:
+                continue  # keep draining so write()/close() never block on a dead writer
+            try:
+                self._write(frame)
+            except Exception as e:
+                self._error = e
+
+    def write(self, frame):
+        if self._error is not None:
+            raise self._error
+        # frames from cap.read() are fresh arrays and never modified afterwards, so no copy
+        if not self.drop_when_full:
+            self._q.put(frame)
+            return
+        while True:
+            try:
+                self._q.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self._q.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
 
     def close(self):
+        self._q.put(None)
+        self._thread.join()
+
         if self.cur_writer is not None:
             self.cur_writer.release()
             self.cur_writer = None
 
+        if self.dropped:
+            print(f"[buffer] dropped {self.dropped} frames (encoder fell behind)", flush=True)
+        if self._error is not None:
+            raise self._error
+
 
 # ------------------ Helpers ------------------
 def safe_crop(img, x1, y1, x2, y2):
+    """
+    Clamped crop as a view into img (no copy). Callers that keep the crop
+    while img may be modified in place must .copy() it themselves.
+    """
     h, w = img.shape[:2]
     x1 = max(0, min(w - 1, int(x1)))
     x2 = max(0, min(w - 1, int(x2)))
@@ -114,14 +278,64 @@ def safe_crop(img, x1, y1, x2, y2):
     y2 = max(0, min(h - 1, int(y2)))
     if x2 <= x1 or y2 <= y1:
         return None
-    crop = img[y1:y2, x1:x2].copy()
+    crop = img[y1:y2, x1:x2]
     return crop if crop.size > 0 else None
 
 
+if njit is not None:
+
+    @njit(inline="always", cache=True)
+    def reflect101(i, n):
+        # cv2.BORDER_REFLECT_101 index (OpenCV's default border for Laplacian)
+        if n == 1:
+            return 0
+        if i < 0:
+            return -i
+        if i >= n:
+            return 2 * n - 2 - i
+        return i
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def lap_var(img):
+        """
+        Variance of the 4-neighbour Laplacian of the green channel, in one
+        native pass. Borders are reflected like cv2.Laplacian, so the result
+        matches the OpenCV path below for any crop size.
+        """
+        h, w = img.shape[0], img.shape[1]
+        s = 0.0
+        s2 = 0.0
+        for y in prange(h):
+            yu = reflect101(y - 1, h)
+            yd = reflect101(y + 1, h)
+            for x in range(w):
+                xl = reflect101(x - 1, w)
+                xr = reflect101(x + 1, w)
+                lap = (
+                    np.float32(img[yu, x, 1]) + np.float32(img[yd, x, 1])
+                    + np.float32(img[y, xl, 1]) + np.float32(img[y, xr, 1])
+                    - 4.0 * np.float32(img[y, x, 1])
+                )
+                s += lap
+                s2 += lap * lap
+        n = h * w
+        return s2 / n - (s / n) ** 2
+
+else:
+    lap_var = None
+
+
 def sharpness_score(img_bgr) -> float:
-    """Higher = sharper (less blur)."""
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    """
+    Higher = sharper (less blur). Measured on the green channel, which
+    carries most of the luma, so no gray conversion pass is needed.
+    """
+    if lap_var is not None:
+        return float(lap_var(img_bgr))
+    # 16-bit Laplacian is exact for uint8 input; meanStdDev avoids a float64 image
+    lap = cv2.Laplacian(img_bgr[:, :, 1], cv2.CV_16S)
+    _, stddev = cv2.meanStdDev(lap)
+    return float(stddev[0, 0]) ** 2
 
 
 def quality_score(img_bgr) -> float:
@@ -136,6 +350,160 @@ def quality_score(img_bgr) -> float:
     return sharp * (area ** 0.5)  # area^0.5 keeps it balanced
 
 
+def associate_plates(plate_xyxy, vehicle_xyxy, vehicle_ids):
+    """
+    Vehicle id for each plate whose center lies inside a vehicle box
+    (first matching vehicle wins, -1 if none). Broadcasts (P,1) vs (1,K).
+    Takes the YOLO box tensors as-is, so the test runs on the plates' device;
+    only the returned (P,) id vector needs to come back to the host.
+    Vehicle boxes are moved there first: older ultralytics trackers rebuild
+    them on the CPU even when the model runs on CUDA.
+    """
+    n_plates = plate_xyxy.shape[0]
+    if n_plates == 0 or vehicle_xyxy.shape[0] == 0:
+        return torch.full((n_plates,), -1, dtype=torch.int32, device=plate_xyxy.device)
+
+    vehicle_xyxy = vehicle_xyxy.to(plate_xyxy.device)
+    vehicle_ids = vehicle_ids.to(plate_xyxy.device)
+
+    cx = ((plate_xyxy[:, 0] + plate_xyxy[:, 2]) / 2)[:, None]
+    cy = ((plate_xyxy[:, 1] + plate_xyxy[:, 3]) / 2)[:, None]
+    hits = (
+        (vehicle_xyxy[None, :, 0] <= cx) & (cx <= vehicle_xyxy[None, :, 2])
+        & (vehicle_xyxy[None, :, 1] <= cy) & (cy <= vehicle_xyxy[None, :, 3])
+    )
+    first = hits.to(torch.uint8).argmax(dim=1)  # first True per row
+    ids = vehicle_ids[first]
+    return torch.where(hits.any(dim=1), ids, torch.full_like(ids, -1))
+
+
+def encode_jpeg_gpu(img):
+    """
+    BGR uint8 crop -> JPEG bytes via torchvision's nvJPEG path. Only the crop
+    goes to the device; the encoded bytes come back.
+    """
+    rgb = torch.from_numpy(np.ascontiguousarray(img[:, :, ::-1])).permute(2, 0, 1)
+    return encode_jpeg(rgb.cuda(), quality=JPEG_QUALITY).cpu().numpy().tobytes()
+
+
+def vehicle_roi(vehicle_xyxy, frame_shape, margin: int = ROI_MARGIN):
+    """
+    (x1, y1, x2, y2) integer bounds of the union of all vehicle boxes plus a
+    margin, clamped to the frame.
+    """
+    h, w = frame_shape[:2]
+    x1, y1 = vehicle_xyxy[:, :2].min(dim=0).values.tolist()
+    x2, y2 = vehicle_xyxy[:, 2:].max(dim=0).values.tolist()
+    return (
+        max(0, int(x1) - margin),
+        max(0, int(y1) - margin),
+        min(w, int(x2) + margin + 1),
+        min(h, int(y2) + margin + 1),
+    )
+
+
+def write_image_async(pool, path, img, gpu_jpeg: bool = False):
+    """
+    JPEG-encode (JPEG_PARAMS) in memory and write the bytes on the I/O pool
+    (cv2 releases the GIL while encoding). Failures are reported from the worker thread;
+    the returned future resolves to True only if the file was written.
+    gpu_jpeg encodes on the GPU instead, falling back to OpenCV if that fails.
+    """
+    def _write():
+        data = None
+        if gpu_jpeg:
+            try:
+                data = encode_jpeg_gpu(img)
+            except Exception:
+                data = None  # e.g. torchvision built without CUDA JPEG support
+        if data is None:
+            ok, buf = cv2.imencode(".jpg", img, JPEG_PARAMS)
+            if not ok:
+                print(f"⚠️ Failed to encode plate crop: {path}", flush=True)
+                return False
+            data = buf.tobytes()
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"⚠️ Failed to write plate crop: {path} ({e})", flush=True)
+            return False
+        return True
+
+    return pool.submit(_write)
+
+
+def write_succeeded(fut) -> bool:
+    """
+    True if a write_image_async future wrote its file (waits for it).
+    """
+    return fut.exception() is None and bool(fut.result())
+
+
+def log_written_rows(pending, writer, wait: bool = False) -> int:
+    """
+    Pop (write future, row) pairs off the front of pending once their write has
+    finished (all of them if wait) and log the rows whose image was saved.
+    Rows stay in submit order. Returns the number of rows logged.
+    """
+    logged = 0
+    while pending and (wait or pending[0][0].done()):
+        fut, row = pending.popleft()
+        if write_succeeded(fut):
+            writer.writerow(row)
+            logged += 1
+    return logged
+
+
+def load_model(weights: str, trt: bool = False, batch: int = 1):
+    """
+    Load a YOLO model. With trt=True on a CUDA machine, use a TensorRT FP16
+    engine instead (exported next to the .pt on first use, then reused).
+    The engine's max batch is fixed at export, so each batch size gets its own file.
+    """
+    if trt and torch.cuda.is_available() and weights.endswith(".pt"):
+        engine = f"{os.path.splitext(weights)[0]}_b{batch}.engine"
+        if not os.path.exists(engine):
+            print(f"[trt] exporting {weights} -> {engine} (one-time, takes a few minutes)", flush=True)
+            exported = YOLO(weights).export(format="engine", half=True, dynamic=True, batch=batch, device=0)
+            os.replace(exported, engine)  # export always writes <stem>.engine
+        return YOLO(engine)
+    return YOLO(weights)
+
+
+@contextmanager
+def cudnn_benchmark_off():
+    """
+    Plate ROI batches change count and letterbox shape from window to window;
+    with cudnn.benchmark on, each new shape would be autotuned inside the loop.
+    """
+    prev = torch.backends.cudnn.benchmark
+    torch.backends.cudnn.benchmark = False
+    try:
+        yield
+    finally:
+        torch.backends.cudnn.benchmark = prev
+
+
+def warmup(model, frame_shape, runs: int = 3, batch: int = 1, **kwargs):
+    """
+    Run a few dummy inferences at the real frame size so CUDA/cuDNN init,
+    kernel autotuning and VRAM allocation happen before the first real frame.
+    batch > 1 sends that many crops of differing sizes instead, the way a
+    window of plate ROIs reaches the detector.
+    """
+    h, w = frame_shape[:2]
+    if batch > 1:
+        dummy = [
+            np.zeros((max(32, h // 2), max(32, w // 2 - 16 * i), 3), dtype=np.uint8)
+            for i in range(batch)
+        ]
+    else:
+        dummy = np.zeros(frame_shape, dtype=np.uint8)
+    for _ in range(runs):
+        model.predict(dummy, verbose=False, **kwargs)
+
+
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("--video", type=str, default="data/record.mp4", help="path to input mp4")
@@ -144,6 +512,13 @@ def parse_args():
 
     ap.add_argument("--car-model", type=str, default="yolov8n.pt", help="YOLO model for vehicles")
     ap.add_argument("--plate-model", type=str, default="", help="path to plate model .pt (optional)")
+    ap.add_argument(
+        "--unified-model",
+        type=str,
+        default="",
+        help="one YOLO model with COCO vehicle classes + a plate class; replaces --car-model/--plate-model",
+    )
+    ap.add_argument("--plate-class", type=int, default=80, help="plate class id in --unified-model")
 
     ap.add_argument("--car-conf", type=float, default=0.35)
     ap.add_argument("--plate-conf", type=float, default=0.35)
@@ -153,6 +528,13 @@ def parse_args():
     # Best-only saving controls
     ap.add_argument("--best-only", action="store_true", help="Save only the best plate image per vehicle ID")
     ap.add_argument("--min-improve", type=float, default=1.15, help="New plate must be this much better to replace old")
+
+    ap.add_argument("--gpu-io", action="store_true", help="decode/encode video on the GPU (NVDEC/NVENC via ffmpegcv)")
+    ap.add_argument("--infer-batch", type=int, default=8, help="frames per batched plate-detector call")
+    ap.add_argument("--plate-stride", type=int, default=3, help="run plate detection on every Nth frame")
+    ap.add_argument("--trt", action="store_true", help="run YOLO models as TensorRT FP16 engines (CUDA only)")
+    ap.add_argument("--gpu-jpeg", action="store_true", help="JPEG-encode plate crops on the GPU (torchvision nvJPEG)")
+    ap.add_argument("--drop-frames", action="store_true", help="drop buffer frames instead of waiting when encoding lags (live input)")
   
 
     return ap.parse_args()
@@ -175,13 +557,29 @@ def main():
     os.makedirs(logs_dir, exist_ok=True)
 
     # Open video
-    cap = cv2.VideoCapture(args.video)
-    if not cap.isOpened():
-        raise RuntimeError(f"❌ Video not opened: {args.video}")
+    gpu_io = args.gpu_io and ffmpegcv is not None and torch.cuda.is_available()
+    if args.gpu_io and not gpu_io:
+        print("⚠️ --gpu-io needs ffmpegcv and CUDA; using OpenCV video I/O.", flush=True)
+
+    gpu_jpeg = args.gpu_jpeg and encode_jpeg is not None and torch.cuda.is_available()
+    if args.gpu_jpeg and not gpu_jpeg:
+        print("⚠️ --gpu-jpeg needs torchvision and CUDA; encoding plates with OpenCV.", flush=True)
+
+    if gpu_io:
+        # NVDEC decode; same read()/release() API as cv2.VideoCapture
+        cap = ffmpegcv.VideoCaptureNV(args.video, pix_fmt="bgr24")
+        if not cap.isOpened():
+            raise RuntimeError(f"❌ Video not opened: {args.video}")
+        fps = cap.fps or 30.0
+        W, H = cap.width, cap.height
+    else:
+        cap = cv2.VideoCapture(args.video)
+        if not cap.isOpened():
+            raise RuntimeError(f"❌ Video not opened: {args.video}")
 
-    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
-    W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
     print("Video opened:", cap.isOpened(), flush=True)
     print("FPS:", fps, flush=True)
@@ -203,14 +601,25 @@ def main():
         frame_size=(W, H),
         chunk_seconds=args.chunk_sec,
         keep_minutes=args.buffer_min,
+        use_gpu=gpu_io,
+        drop_when_full=args.drop_frames,
     )
 
-    # Models
-    car_model = YOLO(args.car_model)
+    # Models (boxes stay on this device until association is done)
+    device = 0 if torch.cuda.is_available() else "cpu"
+    if args.trt and not torch.cuda.is_available():
+        print("⚠️ --trt needs CUDA; using the PyTorch models.", flush=True)
+    unified = bool(args.unified_model)
+    car_model = load_model(
+        args.unified_model or args.car_model, args.trt, batch=1
+    )  # tracking is one frame at a time
 
     plate_model = None
-    if args.plate_model and os.path.exists(args.plate_model):
-        plate_model = YOLO(args.plate_model)
+    if unified:
+        # vehicles and plates come out of the same tracked forward pass
+        print("✅ Unified vehicle+plate model loaded:", args.unified_model, flush=True)
+    elif args.plate_model and os.path.exists(args.plate_model):
+        plate_model = load_model(args.plate_model, args.trt, batch=args.infer_batch)
         print("✅ Plate model loaded:", args.plate_model, flush=True)
     else:
         print("⚠️ Plate model not provided/found. Plate detection will be skipped.", flush=True)
@@ -218,192 +627,321 @@ def main():
     # COCO vehicle classes: car(2), motorcycle(3), bus(5), truck(7)
     vehicle_classes = [2, 3, 5, 7]
 
+    # unified: one pass at the lower threshold, each class re-filtered at its own conf below
+    track_classes = vehicle_classes + [args.plate_class] if unified else vehicle_classes
+    track_conf = min(args.car_conf, args.plate_conf) if unified else args.car_conf
+
+    # Warm up before the capture loop so frame 1 doesn't pay the cold-start cost
+    warmup(car_model, (H, W, 3), conf=track_conf, classes=track_classes, device=device)
+    if plate_model is not None:
+        with cudnn_benchmark_off():
+            warmup(plate_model, (H, W, 3), batch=args.infer_batch, conf=args.plate_conf, device=device)
+    if plate_model is not None or unified:
+        # JIT-compile (or load from cache) the sharpness kernel before the first crop needs it;
+        # crops are slices of the frame, so warm up on a slice (non-contiguous 'A' layout)
+        sharpness_score(np.zeros((16, 16, 3), dtype=np.uint8)[2:10, 2:10])
+
     # Tracking + counts
     seen_vehicle_ids = set()
 
     # For logging: keep ONLY final rows if best-only is enabled
-    best_plate = {}  # tid -> {"score": float, "path": str, "row": dict}
-    log_rows = []    # used when best-only is OFF
+    # best-only state, one flat dict per field keyed by tid (no per-vehicle row dicts)
+    best_score = {}  # tid -> quality score
+    best_path = {}   # tid -> plate image path
+    best_write = {}  # tid -> pending write future for that image
+    best_meta = {}   # tid -> (timestamp, frame, plate_conf, vehicles_in_frame, unique_vehicles_seen)
+
+    # best-only OFF: every saved plate is appended to the log once its image has landed
+    # (only writes still in flight are held in pending_rows);
+    # best-only ON: rows can still be replaced, so the log is written once at the end
+    csv_path = os.path.join(logs_dir, "plate_log.csv")
+    log_file = None
+    if not args.best_only:
+        log_file = open(csv_path, "w", newline="")
+        log_writer = csv.writer(log_file)
+        log_writer.writerow(LOG_COLUMNS)
+    pending_rows = deque()  # (write future, log row), submit order
+    rows_logged = 0
+    rows_flushed = 0
 
     frame_idx = 0
     t0 = time.time()
     last_plate_debug = 0.0
 
-    while True:
+    # plate file names: per-second stamp (strftime'd only when the second changes) + run-wide counter
+    stamp_sec = None
+    sec_stamp = ""
+    plate_seq = 0
+
+    # plate crops are written off the hot loop
+    io_pool = ThreadPoolExecutor(max_workers=2)
+
+    frame_batch = []
+    eof = False
+
+    while not eof:
         ok, frame = cap.read()
-        if not ok:
-            break
+        if ok:
+            frame_batch.append(frame)
+        else:
+            eof = True
 
-        frame_idx += 1
+        # work in windows of --infer-batch frames (partial window at EOF)
+        if not frame_batch or (not eof and len(frame_batch) < args.infer_batch):
+            continue
 
-        if frame_idx == 1:
-            print("[debug] first frame reached, writing to buffer...", flush=True)
+        # 1) + 2) per frame: raw buffer, then vehicle tracking (tracker state is sequential)
+        frame_states = []  # one FrameState per frame in the window
 
-        # 1) store raw buffer
-        buffer_writer.write(frame)
+        for frame in frame_batch:
+            frame_idx += 1
 
-        # 2) detect + track vehicles
-        try:
-            results = car_model.track(
-                source=frame,
-                conf=args.car_conf,
-                classes=vehicle_classes,
-                tracker=args.tracker,
-                persist=True,
-                verbose=False,
-            )[0]
-        except Exception as e:
-            print(f"⚠️ track() failed ({e}). Falling back to predict() (no tracking).", flush=True)
-            results = car_model.predict(
-                source=frame,
-                conf=args.car_conf,
-                classes=vehicle_classes,
-                verbose=False,
-            )[0]
-        # ✅ Make a processed frame (with YOLO boxes drawn)
-        processed_frame = results.plot()
+            if frame_idx == 1:
+                print("[debug] first frame reached, writing to buffer...", flush=True)
 
-        # ✅ Save processed frame into cv2.mp4
-        processed_writer.write(processed_frame)
+            # 1) store raw buffer
+            buffer_writer.write(frame)
 
+            # 2) detect + track vehicles
+            try:
+                results = car_model.track(
+                    source=frame,
+                    conf=track_conf,
+                    classes=track_classes,
+                    tracker=args.tracker,
+                    persist=True,
+                    device=device,
+                    verbose=False,
+                )[0]
+            except Exception as e:
+                print(f"⚠️ track() failed ({e}). Falling back to predict() (no tracking).", flush=True)
+                results = car_model.predict(
+                    source=frame,
+                    conf=track_conf,
+                    classes=track_classes,
+                    device=device,
+                    verbose=False,
+                )[0]
+            # ✅ Make a processed frame (with YOLO boxes drawn)
+            processed_frame = results.plot()
+
+            # ✅ Save processed frame into cv2.mp4
+            processed_writer.write(processed_frame)
+
+
+            # vehicle boxes as (K,4) + (K,) ids (-1 = untracked), left on the model's device
+            vehicle_xyxy = torch.empty((0, 4))
+            vehicle_ids = torch.empty(0, dtype=torch.int32)
+            unified_plates = (torch.empty((0, 4)), None) if unified else None  # (xyxy, conf)
+
+            if results.boxes is not None and results.boxes.xyxy is not None:
+                vehicle_xyxy = results.boxes.xyxy
+                vehicle_ids = torch.full(
+                    (vehicle_xyxy.shape[0],), -1, dtype=torch.int32, device=vehicle_xyxy.device
+                )
 
-        vehicle_boxes = []
-        cars_in_frame = 0
+                if getattr(results.boxes, "id", None) is not None:
+                    try:
+                        vehicle_ids = results.boxes.id.to(torch.int32)
+                    except Exception:
+                        pass
+
+                if unified:
+                    # split the single pass by class, each at its own confidence threshold
+                    boxes = results.boxes
+                    is_plate = boxes.cls == args.plate_class
+                    plate_mask = is_plate & (boxes.conf >= args.plate_conf)
+                    vehicle_mask = ~is_plate & (boxes.conf >= args.car_conf)
+                    unified_plates = (boxes.xyxy[plate_mask], boxes.conf[plate_mask])
+                    vehicle_xyxy = vehicle_xyxy[vehicle_mask]
+                    vehicle_ids = vehicle_ids[vehicle_mask]
+
+            # only the small id vector crosses to the host, queued without waiting on it
+            ids_host = vehicle_ids.to("cpu", non_blocking=True)
+
+            cars_in_frame = int(vehicle_xyxy.shape[0])
+            frame_states.append(
+                FrameState(
+                    frame_no=frame_idx,
+                    frame=frame,
+                    vehicle_xyxy=vehicle_xyxy,
+                    vehicle_ids=vehicle_ids,
+                    cars_in_frame=cars_in_frame,
+                    ids_host=ids_host,
+                    unique_seen=None,
+                    unified_plates=unified_plates,
+                )
+            )
 
-        if results.boxes is not None and results.boxes.xyxy is not None:
-            xyxy = results.boxes.xyxy.cpu().numpy()
+        frame_batch = []
 
-            ids = None
-            if getattr(results.boxes, "id", None) is not None:
-                try:
-                    ids = results.boxes.id.cpu().numpy().astype(int)
-                except Exception:
-                    ids = None
+        # one sync for the whole window's id copies (only if any were on the GPU),
+        # then the running unique count per frame
+        if any(state.vehicle_ids.is_cuda for state in frame_states):
+            torch.cuda.synchronize()
+
+        for k, state in enumerate(frame_states):
+            ids = state.ids_host.numpy()
+            seen_vehicle_ids.update(ids[ids != -1].tolist())
+            frame_states[k] = state._replace(unique_seen=len(seen_vehicle_ids))
 
-            for i in range(len(xyxy)):
-                x1, y1, x2, y2 = xyxy[i]
-                tid = int(ids[i]) if ids is not None else -1
-                vehicle_boxes.append((x1, y1, x2, y2, tid))
-                cars_in_frame += 1
-                if tid != -1:
-                    seen_vehicle_ids.add(tid)
+            # status print every ~2 seconds
+            if state.frame_no % max(1, int(fps * 2)) == 0:
+                elapsed = time.time() - t0
+                print(
+                    f"[t={elapsed:0.1f}s] vehicles_in_frame={state.cars_in_frame} unique_total={len(seen_vehicle_ids)}",
+                    flush=True,
+                )
 
-        # 3) plate detection + crop (only if plate_model is available)
-        if plate_model is not None:
-            pres = plate_model.predict(frame, conf=args.plate_conf, verbose=False)[0]
+        # 3) plate detection + crop (only if plate_model / a unified model is available)
+        if plate_model is None and not unified:
+            continue
+
+        # plates barely move between neighbouring frames: only every --plate-stride'th frame
+        # is checked, and a plate without a vehicle is never saved, so empty frames are skipped
+        plate_stride = max(1, args.plate_stride)
+        plate_states = [
+            state for state in frame_states if state.frame_no % plate_stride == 0 and state.cars_in_frame > 0
+        ]
+        if not plate_states:
+            continue
+
+        if unified:
+            # plates already came out of the tracking pass
+            plate_dets = [state.unified_plates for state in plate_states]
+        else:
+            # plates live on vehicles: detect only inside the union of each frame's vehicle boxes
+            rois = [vehicle_roi(state.vehicle_xyxy, state.frame.shape) for state in plate_states]
+
+            # the plate detector is stateless, so the whole window is one batched forward pass
+            with cudnn_benchmark_off():
+                plate_results = plate_model.predict(
+                    [state.frame[y1:y2, x1:x2] for state, (x1, y1, x2, y2) in zip(plate_states, rois)],
+                    conf=args.plate_conf,
+                    device=device,
+                    verbose=False,
+                )
 
-            if pres.boxes is None or pres.boxes.xyxy is None or len(pres.boxes) == 0:
+            plate_dets = []  # (full-frame xyxy, conf) per frame
+            for (rx, ry, _, _), pres in zip(rois, plate_results):
+                if pres.boxes is None or pres.boxes.xyxy is None or len(pres.boxes) == 0:
+                    plate_dets.append((torch.empty((0, 4)), None))
+                    continue
+                # ROI -> full-frame coordinates
+                offset = torch.tensor([rx, ry, rx, ry], dtype=pres.boxes.xyxy.dtype, device=pres.boxes.xyxy.device)
+                plate_dets.append((pres.boxes.xyxy + offset, pres.boxes.conf))
+
+        for state, (plate_xyxy, plate_conf) in zip(plate_states, plate_dets):
+            frame_no, frame = state.frame_no, state.frame
+            vehicle_xyxy, vehicle_ids = state.vehicle_xyxy, state.vehicle_ids
+            cars_in_frame, unique_seen = state.cars_in_frame, state.unique_seen
+
+            if plate_xyxy.shape[0] == 0:
                 if time.time() - last_plate_debug > 2:
                     print("[debug] no plates detected in recent frames", flush=True)
                     last_plate_debug = time.time()
-            else:
-                pxyxy = pres.boxes.xyxy.cpu().numpy()
-                pconf = pres.boxes.conf.cpu().numpy() if pres.boxes.conf is not None else None
-
-                for j in range(len(pxyxy)):
-                    px1, py1, px2, py2 = pxyxy[j]
-                    confv = float(pconf[j]) if pconf is not None else None
-
-                    crop = safe_crop(frame, px1, py1, px2, py2)
-                    if crop is None:
-                        continue
-
-                    # associate plate -> vehicle if plate center inside a vehicle box
-                    cx = (px1 + px2) / 2
-                    cy = (py1 + py2) / 2
-                    assoc_id = -1
-                    for (x1, y1, x2, y2, tid) in vehicle_boxes:
-                        if x1 <= cx <= x2 and y1 <= cy <= y2:
-                            assoc_id = tid
-                            break
-
-                    # If no tracker id, skip saving (best-only needs a stable ID)
-                    if assoc_id == -1:
-                        continue
-
-                    ts = time.time()
-                    stamp = datetime.fromtimestamp(ts).strftime("%Y%m%d_%H%M%S_%f")
-
-                    # ----- BEST-ONLY logic -----
-                    if args.best_only:
-                        new_score = quality_score(crop)
-                        prev = best_plate.get(assoc_id)
-
-                        # if we already have one, only replace if significantly better
-                        if prev is not None:
-                            if new_score < prev["score"] * float(args.min_improve):
-                                continue  # not better enough, skip saving
-                            # delete old best image
-                            try:
-                                if os.path.exists(prev["path"]):
-                                    os.remove(prev["path"])
-                            except Exception:
-                                pass
-
-                        out_name = f"plate_{stamp}_vid{assoc_id}.jpg"
-                        out_path = os.path.join(plates_dir, out_name)
-
-                        ok_write = cv2.imwrite(out_path, crop)
-                        if not ok_write:
-                            print(f"⚠️ Failed to write plate crop: {out_path}", flush=True)
-                            continue
-
-                        row = {
-                            "timestamp": datetime.fromtimestamp(ts).isoformat(),
-                            "frame": frame_idx,
-                            "plate_path": out_path,
-                            "plate_conf": confv,
-                            "associated_vehicle_id": assoc_id,
-                            "vehicles_in_frame": cars_in_frame,
-                            "unique_vehicles_seen": len(seen_vehicle_ids),
-                            "plate_quality_score": new_score,
-                        }
-
-                        best_plate[assoc_id] = {"score": new_score, "path": out_path, "row": row}
-
-                    # ----- Old behavior (save multiple) -----
-                    else:
-                        out_name = f"plate_{stamp}_vid{assoc_id}.jpg"
-                        out_path = os.path.join(plates_dir, out_name)
-
-                        ok_write = cv2.imwrite(out_path, crop)
-                        if not ok_write:
-                            print(f"⚠️ Failed to write plate crop: {out_path}", flush=True)
-                            continue
-
-                        log_rows.append(
-                            {
-                                "timestamp": datetime.fromtimestamp(ts).isoformat(),
-                                "frame": frame_idx,
-                                "plate_path": out_path,
-                                "plate_conf": confv,
-                                "associated_vehicle_id": assoc_id,
-                                "vehicles_in_frame": cars_in_frame,
-                                "unique_vehicles_seen": len(seen_vehicle_ids),
-                            }
-                        )
-
-        # status print every ~2 seconds
-        if frame_idx % max(1, int(fps * 2)) == 0:
-            elapsed = time.time() - t0
-            print(
-                f"[t={elapsed:0.1f}s] vehicles_in_frame={cars_in_frame} unique_total={len(seen_vehicle_ids)}",
-                flush=True,
-            )
+                continue
+
+            # associate plate -> vehicle (on device) if plate center inside a vehicle box
+            assoc_ids = associate_plates(plate_xyxy, vehicle_xyxy, vehicle_ids).cpu().numpy()
+
+            # If no tracker id, skip saving (best-only needs a stable ID)
+            matched = np.flatnonzero(assoc_ids != -1)
+            if len(matched) == 0:
+                continue
+
+            # crop coordinates + confidences are all the host needs
+            pxyxy = plate_xyxy.cpu().numpy()
+            pconf = plate_conf.cpu().numpy() if plate_conf is not None else None
+
+            # one timestamp per frame; iso string only built if a plate gets saved
+            ts = time.time()
+            frame_dt = datetime.fromtimestamp(ts)
+            if int(ts) != stamp_sec:
+                stamp_sec = int(ts)
+                sec_stamp = frame_dt.strftime("%Y%m%d_%H%M%S")
+            frame_iso = None
+
+            # crop/score/save only the plates that belong to a tracked vehicle
+            for j in matched:
+                assoc_id = int(assoc_ids[j])
+
+                px1, py1, px2, py2 = pxyxy[j]
+                confv = float(pconf[j]) if pconf is not None else None
+
+                crop = safe_crop(frame, px1, py1, px2, py2)
+                if crop is None:
+                    continue
+
+                plate_seq += 1
+                stamp = f"{sec_stamp}_{plate_seq:06d}"  # counter keeps names unique and ordered
+
+                # ----- BEST-ONLY logic -----
+                if args.best_only:
+                    new_score = quality_score(crop)
+                    prev_score = best_score.get(assoc_id)
+
+                    # if we already have one, only replace if significantly better
+                    if prev_score is not None:
+                        if new_score < prev_score * float(args.min_improve):
+                            continue  # not better enough, skip saving
+                        # delete old best image (once its own async write has landed)
+                        try:
+                            best_write[assoc_id].result()
+                            if os.path.exists(best_path[assoc_id]):
+                                os.remove(best_path[assoc_id])
+                        except Exception:
+                            pass
+
+                    out_name = f"plate_{stamp}_vid{assoc_id}.jpg"
+                    out_path = os.path.join(plates_dir, out_name)
+
+                    # copy: a queued view would keep the whole decoded frame alive until it's written
+                    best_write[assoc_id] = write_image_async(io_pool, out_path, crop.copy(), gpu_jpeg)
+                    frame_iso = frame_iso or frame_dt.isoformat()
+
+                    best_score[assoc_id] = new_score
+                    best_path[assoc_id] = out_path
+                    best_meta[assoc_id] = (frame_iso, frame_no, confv, cars_in_frame, unique_seen)
+
+                # ----- Old behavior (save multiple) -----
+                else:
+                    out_name = f"plate_{stamp}_vid{assoc_id}.jpg"
+                    out_path = os.path.join(plates_dir, out_name)
+
+                    fut = write_image_async(io_pool, out_path, crop.copy(), gpu_jpeg)
+                    frame_iso = frame_iso or frame_dt.isoformat()
+
+                    # the row is logged only after its image is on disk
+                    pending_rows.append(
+                        (fut, (frame_iso, frame_no, out_path, confv, assoc_id, cars_in_frame, unique_seen))
+                    )
+                    rows_logged += log_written_rows(pending_rows, log_writer)
+                    if rows_logged - rows_flushed >= LOG_FLUSH_EVERY:
+                        log_file.flush()
+                        rows_flushed = rows_logged
 
     cap.release()
     buffer_writer.close()
     processed_writer.release()
+    io_pool.shutdown(wait=True)
 
 
     # Save log
-    csv_path = os.path.join(logs_dir, "plate_log.csv")
-
     if args.best_only:
-        final_rows = [v["row"] for v in best_plate.values()]
-        pd.DataFrame(final_rows).to_csv(csv_path, index=False)
+        # rows are only assembled here, once per vehicle; the pool is drained, so every
+        # write has resolved and vehicles whose best image failed to save are left out
+        with open(csv_path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(LOG_COLUMNS + ["plate_quality_score"])
+            w.writerows(
+                (ts_iso, frame_no, best_path[tid], confv, tid, cars, unique, best_score[tid])
+                for tid, (ts_iso, frame_no, confv, cars, unique) in best_meta.items()
+                if write_succeeded(best_write[tid])
+            )
     else:
-        pd.DataFrame(log_rows).to_csv(csv_path, index=False)
+        log_written_rows(pending_rows, log_writer, wait=True)
+        log_file.close()
 
     print("\n✅ DONE", flush=True)
     print("Frames actually read:", frame_idx, flush=True)
@@ -411,7 +949,8 @@ def main():
     print("Plates:", plates_dir, flush=True)
     print("Log:", csv_path, flush=True)
     if args.best_only:
-        print(f"Best-only saved plates (unique vehicles): {len(best_plate)}", flush=True)
+        saved = sum(1 for fut in best_write.values() if write_succeeded(fut))
+        print(f"Best-only saved plates (unique vehicles): {saved}", flush=True)
 
 
 if __name__ == "__main__":
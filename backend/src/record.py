@@ -1,5 +1,6 @@
 import cv2
 import datetime
+from collections import deque
 from pathlib import Path
 
 
@@ -9,11 +10,54 @@ FPS = 20
 CODEC = 'XVID'
 OUTPUT_FILE = "motion_recording.mp4"
 
-MOTION_THRESHOLD = 5000
+# Motion is measured on a half-resolution copy, so the pixel threshold is 1/4
+DETECT_SIZE = (FRAME_WIDTH // 2, FRAME_HEIGHT // 2)
+MOTION_THRESHOLD = 1250
 RECORD_SECONDS_AFTER_MOTION = 5
-
-
-def record():
+# While idle only every Nth frame is diffed; recent frames are kept so the
+# clip still starts with the footage leading up to the trigger.
+IDLE_DETECT_EVERY = 3
+PREBUFFER_SECONDS = 2
+BLUR_KSIZE = (5, 5)
+
+# Per-pixel motion math runs on the GPU when OpenCV is built with CUDA,
+# otherwise through UMat so OpenCV can dispatch to OpenCL.
+USE_CUDA = hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+
+
+def make_blur():
+    if USE_CUDA:
+        box = cv2.cuda.createBoxFilter(cv2.CV_8UC1, cv2.CV_8UC1, BLUR_KSIZE)
+        return box.apply
+    return lambda gray: cv2.boxFilter(gray, -1, BLUR_KSIZE)
+
+
+def prepare(frame, blur):
+    # BGR frame -> downsampled, blurred gray, left on the device
+    if USE_CUDA:
+        gpu = cv2.cuda_GpuMat()
+        gpu.upload(frame)
+        gray = cv2.cuda.cvtColor(gpu, cv2.COLOR_BGR2GRAY)
+        gray = cv2.cuda.resize(gray, DETECT_SIZE, interpolation=cv2.INTER_AREA)
+    else:
+        gray = cv2.cvtColor(cv2.UMat(frame), cv2.COLOR_BGR2GRAY)
+        gray = cv2.resize(gray, DETECT_SIZE, interpolation=cv2.INTER_AREA)
+    return blur(gray)
+
+
+def count_motion(prev_gray, gray):
+    # only the scalar pixel count comes back to the host
+    if USE_CUDA:
+        frame_diff = cv2.cuda.absdiff(prev_gray, gray)
+        thresh = cv2.cuda.threshold(frame_diff, 25, 255, cv2.THRESH_BINARY)[1]
+        return cv2.cuda.countNonZero(thresh)
+    frame_diff = cv2.absdiff(prev_gray, gray)
+    thresh = cv2.threshold(frame_diff, 25, 255, cv2.THRESH_BINARY)[1]
+    return cv2.countNonZero(thresh)
+
+
+def record(on_clip=None):
+    # on_clip(path) is called with the absolute path of every finished recording
     cap = cv2.VideoCapture(0)
 
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
@@ -31,8 +75,11 @@ def record():
         print('No camera available')
         return
 
-    prev_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
-    prev_gray = cv2.GaussianBlur(prev_gray, (21, 21), 0)
+    blur = make_blur()
+    prev_gray = prepare(prev_frame, blur)
+
+    frame_counter = 0
+    prebuf = deque(maxlen=FPS * PREBUFFER_SECONDS)
 
     print("System Ready... Monitoring for motion.")
 
@@ -41,12 +88,13 @@ def record():
         if not ret:
             break
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-        frame_diff = cv2.absdiff(prev_gray, gray)
-        thresh = cv2.threshold(frame_diff, 25, 255, cv2.THRESH_BINARY)[1]
-        motion_pixels = cv2.countNonZero(thresh)
+        frame_counter += 1
+        if recording or frame_counter % IDLE_DETECT_EVERY == 0:
+            gray = prepare(frame, blur)
+            motion_pixels = count_motion(prev_gray, gray)
+            prev_gray = gray
+        else:
+            motion_pixels = 0
 
         if motion_pixels > MOTION_THRESHOLD:
             print("Motion Detected!")
@@ -57,6 +105,9 @@ def record():
 
                 out = cv2.VideoWriter(filename, fourcc, FPS,
                                       (FRAME_WIDTH, FRAME_HEIGHT))
+                for buffered in prebuf:
+                    out.write(buffered)
+                prebuf.clear()
                 recording = True
 
             motion_timer = RECORD_SECONDS_AFTER_MOTION * FPS
@@ -69,8 +120,11 @@ def record():
                 print("Recording stopped.")
                 recording = False
                 out.release()
-
-        prev_gray = gray
+                if on_clip:
+                    on_clip(str(Path(filename).resolve()))
+        else:
+            # cap.read() hands back a fresh array each call, so no copy is needed
+            prebuf.append(frame)
 
         cv2.imshow("Camera", frame)
 
@@ -80,12 +134,10 @@ def record():
     cap.release()
     if out:
         out.release()
+        if recording and on_clip:
+            on_clip(str(Path(filename).resolve()))
     cv2.destroyAllWindows()
 
 
 if __name__ == '__main__':
     record()
-def record():
-    print("Recording started...")
-    # Simulate recording process
-    print("Recording completed.")
\ No newline at end of file